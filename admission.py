@@ -0,0 +1,109 @@
+import asyncio
+import os
+from fastapi import HTTPException, status
+
+class AdmissionLimiter:
+    """
+    Concurrency limit with a bounded wait queue for one group of routes.
+
+    Up to `max_concurrent` requests run at once. Up to `max_waiting` more wait for at most
+    `wait_timeout` seconds. Anything beyond that is rejected right away with 429, and a wait
+    that times out gets 503. Both carry a Retry-After header, so a flood of slow requests
+    cannot hold every worker slot.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_waiting: int, wait_timeout: float, retry_after: int):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+        # Metrics
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    def _reject(self, status_code: int, detail: str):
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+    async def acquire(self):
+        # ✅ Every decision below is taken on counters updated before the first await, so requests
+        # arriving in the same tick see each other and the queue bound holds under a burst
+        if self.in_flight < self.max_concurrent and self.waiting == 0:
+            self.in_flight += 1
+            self.admitted += 1
+            await self._semaphore.acquire()  # A free slot was counted, this does not wait
+            return
+
+        if self.in_flight + self.waiting >= self.max_concurrent + self.max_waiting:
+            self.rejected_queue_full += 1
+            self._reject(status.HTTP_429_TOO_MANY_REQUESTS, f"Too many '{self.name}' requests, try again later")
+
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, f"Server busy with '{self.name}' requests, try again later")
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        self.admitted += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_waiting": self.max_waiting,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout
+        }
+
+# Route group name -> limiter
+limiters = {}
+
+def route_group(name: str, max_concurrent: int, max_waiting: int, wait_timeout: float = 5.0, retry_after: int = 2):
+    """
+    Declares a route group and returns a FastAPI dependency that enforces its limits.
+
+    Limits passed here are the defaults; ADMISSION_<NAME>_CONCURRENCY, _QUEUE, _TIMEOUT and
+    _RETRY_AFTER environment variables override them per deployment.
+    """
+    if name in limiters:
+        raise ValueError(f"Route group '{name}' is already declared")
+
+    prefix = f"ADMISSION_{name.upper()}"
+    limiter = AdmissionLimiter(
+        name,
+        max_concurrent=int(os.getenv(f"{prefix}_CONCURRENCY", max_concurrent)),
+        max_waiting=int(os.getenv(f"{prefix}_QUEUE", max_waiting)),
+        wait_timeout=float(os.getenv(f"{prefix}_TIMEOUT", wait_timeout)),
+        retry_after=int(os.getenv(f"{prefix}_RETRY_AFTER", retry_after))
+    )
+    limiters[name] = limiter
+
+    async def admission_control():
+        await limiter.acquire()
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    return admission_control
+
+def admission_stats() -> dict:
+    return {name: limiter.stats() for name, limiter in limiters.items()}
@@ -0,0 +1,92 @@
+import asyncio
+import os
+from datetime import timedelta
+import clock
+from database import SessionLocal
+from models import Account, Loans, LoanHistory, ChainOutbox
+from enums import BidStatus
+from outbox import OPEN_STATUSES
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+BATCH_SIZE = int(os.getenv("LOAN_ARCHIVE_BATCH_SIZE", "500"))
+# Settled loans stay in `loans` this long after their end date (minutes, like the loan terms)
+RETENTION_MINUTES = int(os.getenv("LOAN_ARCHIVE_RETENTION_MINUTES", "60"))
+# 0 disables the periodic job, archival then only runs through POST /admin/archive-loans
+INTERVAL_SECONDS = float(os.getenv("LOAN_ARCHIVE_INTERVAL_SECONDS", "0"))
+
+SETTLED_STATUSES = (BidStatus.PAID, BidStatus.REJECTED)
+
+def archive_settled_loans(db, batch_size: int = BATCH_SIZE, retention_minutes: int = RETENTION_MINUTES) -> int:
+    """
+    Moves settled loans past their retention window from `loans` into `loan_history`.
+
+    Works in batches of `batch_size`, one commit per batch, so a large backlog never holds a
+    long write transaction. Loans with outbox entries still open are left alone until the
+    transfer settles. Returns the number of loans archived.
+    """
+    cutoff = (clock.now() - timedelta(minutes=retention_minutes)).strftime(DATE_FORMAT)
+    loans_in_flight = db.query(ChainOutbox.loan_id).filter(
+        ChainOutbox.loan_id.isnot(None), ChainOutbox.status.in_(OPEN_STATUSES))
+
+    archived = 0
+    while True:
+        loans = db.query(Loans).filter(
+            Loans.status.in_(SETTLED_STATUSES),
+            Loans.end_date < cutoff,
+            Loans.loan_id.notin_(loans_in_flight)
+        ).order_by(Loans.loan_id).limit(batch_size).all()
+
+        if not loans:
+            break
+
+        account_ids = {loan.account_id for loan in loans}
+        owners = dict(db.query(Account.account_id, Account.user_id).filter(Account.account_id.in_(account_ids)).all())
+        archived_at = clock.now().strftime(DATE_FORMAT)
+
+        for loan in loans:
+            db.add(LoanHistory(
+                loan_id=loan.loan_id,
+                account_id=loan.account_id,
+                user_id=owners.get(loan.account_id),
+                amount=loan.amount,
+                interest_rate=loan.interest_rate,
+                duration_months=loan.duration_months,
+                start_date=loan.start_date,
+                end_date=loan.end_date,
+                remaining_balance=loan.remaining_balance,
+                status=loan.status,
+                archived_at=archived_at
+            ))
+            db.delete(loan)
+
+        db.commit()
+        archived += len(loans)
+
+        if len(loans) < batch_size:
+            break
+
+    return archived
+
+def archive_once(batch_size: int = BATCH_SIZE, retention_minutes: int = RETENTION_MINUTES) -> int:
+    """
+    One archival run in its own session, for callers on the event loop (run it in a thread).
+    """
+    db = SessionLocal()
+    try:
+        return archive_settled_loans(db, batch_size=batch_size, retention_minutes=retention_minutes)
+    finally:
+        db.close()
+
+async def run_archive_job():
+    """
+    Background loop started from the app lifespan when LOAN_ARCHIVE_INTERVAL_SECONDS > 0.
+    """
+    while True:
+        try:
+            archived = await asyncio.to_thread(archive_once)
+            if archived:
+                print(f"📦 Archived {archived} settled loans")
+        except Exception as e:
+            print(f"⚠️ Loan archival failed: {e}")
+        await asyncio.sleep(INTERVAL_SECONDS)
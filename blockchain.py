@@ -0,0 +1,251 @@
+import asyncio
+import os
+import time
+from threading import Lock
+
+ganache_url = os.getenv("GANACHE_URL")
+
+# Comma separated list of RPC endpoints, falls back to the single GANACHE_URL
+RPC_URLS = [url.strip() for url in os.getenv("RPC_URLS", "").split(",") if url.strip()] or [ganache_url]
+RPC_TIMEOUT_SECONDS = float(os.getenv("RPC_TIMEOUT_SECONDS", "10"))
+HEALTH_CHECK_SECONDS = float(os.getenv("RPC_HEALTH_CHECK_SECONDS", "5"))
+# A node this many blocks behind the best one is treated as unhealthy
+MAX_BLOCK_LAG = int(os.getenv("RPC_MAX_BLOCK_LAG", "5"))
+LATENCY_SMOOTHING = 0.3
+
+def is_transport_error(error: Exception) -> bool:
+    """
+    Whether `error` means the node itself failed: unreachable, timed out or answering with an
+    HTTP 5xx.
+
+    Errors about the request (JSON-RPC errors, invalid addresses, insufficient funds, nonce too
+    low, a receipt wait running out) say nothing about the node and must not mark it unhealthy.
+    """
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code >= 500
+    # Connection refused/reset and timeouts; requests' ConnectionError and Timeout are OSErrors too
+    if isinstance(error, OSError):
+        return True
+    return any(cls.__name__ == "ProviderConnectionError" for cls in type(error).__mro__)
+
+class RpcEndpoint:
+    """
+    One RPC node plus what the health checks know about it.
+    """
+
+    def __init__(self, name: str, web3):
+        self.name = name
+        self.web3 = web3
+        self.healthy = True  # Until a check or a call says otherwise
+        self.latency = None  # Smoothed seconds per health check call
+        self.block_number = None
+        self.failures = 0
+        self.last_error = None
+
+    def record_success(self, seconds: float, block_number: int = None):
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        self.latency = seconds if self.latency is None else \
+            LATENCY_SMOOTHING * seconds + (1 - LATENCY_SMOOTHING) * self.latency
+        if block_number is not None:
+            self.block_number = block_number
+
+    def record_failure(self, error: Exception):
+        self.healthy = False
+        self.failures += 1
+        self.last_error = str(error)
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "latency_ms": round(self.latency * 1000, 2) if self.latency is not None else None,
+            "block_number": self.block_number,
+            "failures": self.failures,
+            "last_error": self.last_error
+        }
+
+class RpcRouter:
+    """
+    Routes chain calls over several RPC endpoints.
+
+    Reads go to the fastest healthy node and fail over to the next one on error. Writes for
+    a sender stay pinned to one node, so its nonces come from a single mempool. The pin moves
+    only when that node fails, and the caller (the outbox worker) retries on the new node.
+    """
+
+    def __init__(self, endpoints):
+        if not endpoints:
+            raise ValueError("At least one RPC endpoint is required")
+        self.endpoints = list(endpoints)
+        self._pins = {}  # sender address -> RpcEndpoint
+        self._lock = Lock()
+
+    def _by_preference(self):
+        with self._lock:
+            healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+            unhealthy = [endpoint for endpoint in self.endpoints if not endpoint.healthy]
+        # Fastest healthy first; unmeasured nodes after measured ones; unhealthy nodes as a last resort
+        by_latency = lambda endpoint: (endpoint.latency is None, endpoint.latency or 0.0)
+        return sorted(healthy, key=by_latency) + sorted(unhealthy, key=by_latency)
+
+    def read_endpoint(self) -> RpcEndpoint:
+        return self._by_preference()[0]
+
+    def sender_endpoint(self, address: str) -> RpcEndpoint:
+        with self._lock:
+            pinned = self._pins.get(address)
+            if pinned is not None and pinned.healthy:
+                return pinned
+        endpoint = self.read_endpoint()
+        with self._lock:
+            self._pins[address] = endpoint
+        return endpoint
+
+    def read(self, call):
+        """
+        Runs `call(web3)` on the fastest healthy node, trying the others if it cannot be reached.
+
+        Errors caused by the request itself are raised right away, leaving node health alone.
+        """
+        last_error = None
+        for endpoint in self._by_preference():
+            try:
+                return call(endpoint.web3)
+            except Exception as e:
+                if not is_transport_error(e):
+                    raise
+                endpoint.record_failure(e)
+                last_error = e
+        raise last_error
+
+    def write(self, address: str, call):
+        """
+        Runs `call(web3)` on the node pinned to `address`.
+
+        There is no automatic retry: a send that failed may still have reached the node, and
+        only the caller knows how to retry safely (the outbox re-checks the stored nonce first).
+        Only transport errors move the pin; a rejected transaction keeps the sender on its node.
+        """
+        endpoint = self.sender_endpoint(address)
+        try:
+            return call(endpoint.web3)
+        except Exception as e:
+            if not is_transport_error(e):
+                raise
+            endpoint.record_failure(e)
+            with self._lock:
+                if self._pins.get(address) is endpoint:
+                    del self._pins[address]
+            raise
+
+    def check_health(self):
+        for endpoint in self.endpoints:
+            started = time.perf_counter()
+            try:
+                block_number = endpoint.web3.eth.block_number
+            except Exception as e:
+                endpoint.record_failure(e)
+                continue
+            endpoint.record_success(time.perf_counter() - started, block_number)
+
+        # ✅ Nodes that fell behind the best one answer, but with stale state
+        best_block = max((endpoint.block_number or 0 for endpoint in self.endpoints if endpoint.healthy), default=0)
+        for endpoint in self.endpoints:
+            if endpoint.healthy and (endpoint.block_number or 0) < best_block - MAX_BLOCK_LAG:
+                endpoint.record_failure(RuntimeError(f"{best_block - endpoint.block_number} blocks behind"))
+
+    def is_healthy(self) -> bool:
+        return any(endpoint.healthy for endpoint in self.endpoints)
+
+    def status(self) -> list:
+        return [endpoint.status() for endpoint in self.endpoints]
+
+# Built on first use (or by the lifespan warm-up), never at import time
+_router = None
+_chain_id = None
+
+def _build_router():
+    from web3 import Web3
+    return RpcRouter([
+        RpcEndpoint(url, Web3(Web3.HTTPProvider(url, request_kwargs={"timeout": RPC_TIMEOUT_SECONDS})))
+        for url in RPC_URLS
+    ])
+
+def get_router() -> RpcRouter:
+    """
+    Returns the shared RPC router, building the providers on first call.
+
+    The web3 package itself is only imported then, so importing the routers stays cheap and a
+    worker restart does not pay for it up front.
+    """
+    global _router
+    if _router is None:
+        _router = _build_router()
+    return _router
+
+def set_endpoints(endpoints):
+    """
+    Replaces the RPC endpoints (a list of `RpcEndpoint`) and returns the previous router, e.g.
+    to run against local stand-in nodes.
+    """
+    global _router, _chain_id
+    previous, _router = _router, RpcRouter(endpoints)
+    _chain_id = None
+    return previous
+
+def set_web3(web3):
+    """
+    Replaces the endpoints with a single client (e.g. an in-process chain for the simulator)
+    and returns the previous router. Passing a router back restores it.
+    """
+    global _router, _chain_id
+    previous = _router
+    _router = web3 if web3 is None or isinstance(web3, RpcRouter) else RpcRouter([RpcEndpoint("default", web3)])
+    _chain_id = None
+    return previous
+
+def is_healthy() -> bool:
+    # As of the last health check: never builds the router or calls a node, so probes stay cheap
+    return _router is not None and _router.is_healthy()
+
+def read(call):
+    return get_router().read(call)
+
+def write(address: str, call):
+    return get_router().write(address, call)
+
+def get_chain_id():
+    # ✅ The chain id never changes for a running network, so only ask for it once
+    global _chain_id
+    if _chain_id is None:
+        _chain_id = read(lambda web3: web3.eth.chain_id)
+    return _chain_id
+
+def warm_up():
+    """
+    Health-checks every endpoint and caches the chain id.
+
+    Returns True when at least one node answered, False otherwise (the caller decides what
+    "not ready" means).
+    """
+    try:
+        router = get_router()
+        router.check_health()
+        return router.is_healthy() and get_chain_id() is not None
+    except Exception as e:
+        print(f"⚠️ Blockchain warm-up failed: {e}")
+        return False
+
+async def run_health_checks():
+    """
+    Background loop started from the app lifespan: re-checks every endpoint periodically.
+    """
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_SECONDS)
+        try:
+            await asyncio.to_thread(get_router().check_health)
+        except Exception as e:
+            print(f"⚠️ RPC health check failed: {e}")
@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+class TTLCache:
+    """
+    Small in-process LRU cache whose entries also expire after `ttl_seconds`.
+
+    The TTL bounds how stale an entry can get when another worker process changed the
+    underlying row (invalidation only reaches the cache of the process that wrote it).
+    """
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 30.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)  # Evict the least recently used entry
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,20 @@
+from datetime import datetime
+
+_now = datetime.now
+
+def now() -> datetime:
+    """
+    Current time for loan terms, overdue sweeps and archival.
+
+    Loan durations are minutes standing in for months, so the simulator swaps in an
+    accelerated clock through `set_clock` instead of sleeping.
+    """
+    return _now()
+
+def set_clock(now_function):
+    """
+    Installs `now_function` as the clock and returns the previous one.
+    """
+    global _now
+    previous, _now = _now, now_function
+    return previous
@@ -0,0 +1,204 @@
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import Loans, LoanHistory, CreditFeatures
+from enums import BidStatus
+from cache import TTLCache
+import clock
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Risk policy for request_loan (environment overridable)
+MAX_DEFAULTS = int(os.getenv("CREDIT_MAX_DEFAULTS", "2"))
+MAX_DEFAULT_RATIO = float(os.getenv("CREDIT_MAX_DEFAULT_RATIO", "0.5"))
+MIN_HISTORY_FOR_RATIO = int(os.getenv("CREDIT_MIN_HISTORY_FOR_RATIO", "2"))
+MAX_LATE_PAYOFFS = int(os.getenv("CREDIT_MAX_LATE_PAYOFFS", "2"))
+# Share of everything ever borrowed that is still owed on earlier loans
+MAX_OUTSTANDING_RATIO = float(os.getenv("CREDIT_MAX_OUTSTANDING_RATIO", "0.5"))
+
+# Penalty on the remaining balance of an overdue loan (punish_missed_payments)
+PENALTY_RATE = 0.10
+
+feature_cache = TTLCache(
+    max_size=int(os.getenv("CREDIT_FEATURE_CACHE_SIZE", "10000")),
+    ttl_seconds=float(os.getenv("CREDIT_FEATURE_CACHE_TTL_SECONDS", "60"))
+)
+
+_INVALIDATE_KEY = "credit_features_invalidate"
+
+COUNTERS = ("loans_requested", "loans_approved", "loans_rejected", "loans_repaid", "loans_defaulted",
+            "late_payoffs", "repayment_count")
+AMOUNTS = ("penalties_total", "total_borrowed", "total_repaid", "payoff_minutes_total", "outstanding_balance")
+
+def _snapshot(features: CreditFeatures) -> dict:
+    snapshot = {column.name: getattr(features, column.name) for column in CreditFeatures.__table__.columns}
+    settled = features.loans_repaid + features.loans_defaulted
+    snapshot["default_ratio"] = features.loans_defaulted / settled if settled else 0.0
+    snapshot["avg_payoff_minutes"] = features.payoff_minutes_total / features.loans_repaid if features.loans_repaid else None
+    snapshot["avg_repayment"] = features.total_repaid / features.repayment_count if features.repayment_count else None
+    snapshot["outstanding_ratio"] = features.outstanding_balance / features.total_borrowed if features.total_borrowed else 0.0
+    return snapshot
+
+def _rebuild(db, account_id: int) -> CreditFeatures:
+    """
+    Builds the features of an account that predates the store from its loan history.
+
+    History alone cannot tell a punished loan from a repaid one (both end PAID) or count
+    installments, so those features start from what is known and are exact from then on.
+    """
+    features = CreditFeatures(account_id=account_id, updated_at=clock.now().strftime(DATE_FORMAT))
+    for name in COUNTERS:
+        setattr(features, name, 0)
+    for name in AMOUNTS:
+        setattr(features, name, 0.0)
+
+    # Counts what is stored, so callers record the transition in progress on top of it
+    with db.no_autoflush:
+        loans = db.query(Loans.amount, Loans.remaining_balance, Loans.status).filter(Loans.account_id == account_id).all()
+        loans += db.query(LoanHistory.amount, LoanHistory.remaining_balance, LoanHistory.status).filter(
+            LoanHistory.account_id == account_id).all()
+
+    for amount, remaining_balance, status in loans:
+        features.loans_requested += 1
+        if status == BidStatus.REJECTED:
+            features.loans_rejected += 1
+        elif status in (BidStatus.APPROVED, BidStatus.PAID):
+            features.loans_approved += 1
+            features.total_borrowed += amount
+        if status == BidStatus.PAID:
+            features.loans_repaid += 1
+        if status == BidStatus.APPROVED:
+            features.outstanding_balance += remaining_balance
+
+    db.add(features)
+    return features
+
+def _features_for_update(db, account_id: int) -> CreditFeatures:
+    features = db.query(CreditFeatures).filter(CreditFeatures.account_id == account_id).first()
+    if features is None:
+        features = _rebuild(db, account_id)
+    features.updated_at = clock.now().strftime(DATE_FORMAT)
+    db.info.setdefault(_INVALIDATE_KEY, set()).add(account_id)
+    return features
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_cache(session):
+    for account_id in session.info.pop(_INVALIDATE_KEY, ()):
+        feature_cache.invalidate(account_id)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_invalidations(session, previous_transaction):
+    session.info.pop(_INVALIDATE_KEY, None)
+
+### Read path ###
+
+def get_credit_features(db, account_id: int) -> dict:
+    """
+    One cached lookup of the account's credit features (read-only dict).
+    """
+    snapshot = feature_cache.get(account_id)
+    if snapshot is not None:
+        return snapshot
+
+    features = db.query(CreditFeatures).filter(CreditFeatures.account_id == account_id).first()
+    if features is None:
+        # Not persisted here: the first loan transition stores it
+        features = _rebuild(db, account_id)
+        db.expunge(features)
+
+    snapshot = _snapshot(features)
+    feature_cache.set(account_id, snapshot)
+    return snapshot
+
+def assess_loan_request(features: dict):
+    """
+    Returns the reason to refuse a new loan, or None when the features allow it.
+    """
+    if features["loans_defaulted"] >= MAX_DEFAULTS:
+        return f"Loan refused: {features['loans_defaulted']} previous loans ended in penalties"
+
+    settled = features["loans_repaid"] + features["loans_defaulted"]
+    if settled >= MIN_HISTORY_FOR_RATIO and features["default_ratio"] > MAX_DEFAULT_RATIO:
+        return "Loan refused: too many previous loans ended in penalties"
+
+    if features["late_payoffs"] >= MAX_LATE_PAYOFFS:
+        return f"Loan refused: {features['late_payoffs']} previous loans were paid off after their end date"
+
+    if features["outstanding_ratio"] > MAX_OUTSTANDING_RATIO:
+        return "Loan refused: too much is still owed on previous loans"
+
+    return None
+
+### Incremental updates, one per loan state transition (committed by the caller) ###
+
+def record_loan_requested(db, account_id: int):
+    features = _features_for_update(db, account_id)
+    features.loans_requested += 1
+
+def record_loan_decision(db, loan: Loans, approved: bool):
+    features = _features_for_update(db, loan.account_id)
+    if approved:
+        features.loans_approved += 1
+        features.total_borrowed += loan.amount
+        features.outstanding_balance += loan.remaining_balance
+    else:
+        features.loans_rejected += 1
+
+def _payoff(loan: Loans, paid_at: datetime):
+    # Minutes from approval (end_date minus the term) to payoff, and whether it came after end_date
+    end_date = datetime.strptime(loan.end_date, DATE_FORMAT)
+    approved_at = end_date - timedelta(minutes=loan.duration_months.value)
+    return max((paid_at - approved_at).total_seconds() / 60, 0.0), paid_at > end_date
+
+def record_repayment(db, loan: Loans, amount: float, paid_off: bool):
+    features = _features_for_update(db, loan.account_id)
+    features.repayment_count += 1
+    features.total_repaid += amount
+    features.outstanding_balance = max(features.outstanding_balance - amount, 0.0)
+
+    if paid_off:
+        payoff_minutes, late = _payoff(loan, clock.now())
+        features.loans_repaid += 1
+        features.payoff_minutes_total += payoff_minutes
+        if late:
+            features.late_payoffs += 1
+
+def record_penalty(db, loan: Loans, original_due: float, penalty: float, collected: float):
+    features = _features_for_update(db, loan.account_id)
+    features.loans_defaulted += 1
+    features.penalties_total += penalty
+    features.total_repaid += collected
+    # The loan is closed, but whatever the sweep could not collect is still owed
+    features.outstanding_balance = max(features.outstanding_balance - original_due, 0.0) + \
+        max(original_due + penalty - collected, 0.0)
+
+### Reversals, for transitions whose chain transfer failed (see outbox._compensate_loan) ###
+
+def revert_loan_decision(db, loan: Loans):
+    features = _features_for_update(db, loan.account_id)
+    features.loans_approved = max(features.loans_approved - 1, 0)
+    features.total_borrowed = max(features.total_borrowed - loan.amount, 0.0)
+    features.outstanding_balance = max(features.outstanding_balance - loan.remaining_balance, 0.0)
+
+def revert_repayment(db, loan: Loans, amount: float, paid_off: bool, paid_at: datetime):
+    features = _features_for_update(db, loan.account_id)
+    features.repayment_count = max(features.repayment_count - 1, 0)
+    features.total_repaid = max(features.total_repaid - amount, 0.0)
+    features.outstanding_balance += amount
+
+    if paid_off:
+        payoff_minutes, late = _payoff(loan, paid_at)
+        features.loans_repaid = max(features.loans_repaid - 1, 0)
+        features.payoff_minutes_total = max(features.payoff_minutes_total - payoff_minutes, 0.0)
+        if late:
+            features.late_payoffs = max(features.late_payoffs - 1, 0)
+
+def revert_penalty(db, loan: Loans, original_due: float, collected: float):
+    penalty = original_due * PENALTY_RATE
+    features = _features_for_update(db, loan.account_id)
+    features.loans_defaulted = max(features.loans_defaulted - 1, 0)
+    features.penalties_total = max(features.penalties_total - penalty, 0.0)
+    features.total_repaid = max(features.total_repaid - collected, 0.0)
+    features.outstanding_balance = max(features.outstanding_balance - max(original_due + penalty - collected, 0.0), 0.0) + \
+        original_due
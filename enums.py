@@ -27,4 +27,14 @@ class BidStatus(Enum):
     PAID = "paid"
 
     def __str__(self):
-        return self.value
\ No newline at end of file
+        return self.value
+
+class OutboxStatus(Enum):
+    PENDING = "pending"      # Recorded with the business change, not sent yet
+    SENT = "sent"            # Handed to the node, waiting for the receipt
+    CONFIRMED = "confirmed"  # Mined successfully
+    FAILED = "failed"        # Reverted or out of retries
+    NEEDS_REVIEW = "needs_review"  # Nonce used by another transaction, reconcile by hand
+
+    def __str__(self):
+        return self.value
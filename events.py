@@ -0,0 +1,92 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+ADMIN_CHANNEL = "admin"
+
+# How long an idle stream waits before sending a keep-alive comment
+KEEP_ALIVE_SECONDS = 15
+
+# Put on a channel's queues to end its streams (see EventBus.close)
+_CLOSED = object()
+
+class EventBus:
+    """
+    In-process publish/subscribe for loan and transfer status changes.
+
+    Every subscriber gets its own bounded queue. A slow client that lets its queue fill up
+    loses the oldest events instead of blocking the request that published them.
+    """
+
+    def __init__(self, max_queue_size: int = 100):
+        self.max_queue_size = max_queue_size
+        self._subscribers = {}  # channel -> set of asyncio.Queue
+
+    def subscribe(self, channel):
+        queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._subscribers.setdefault(channel, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        queues = self._subscribers.get(channel)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[channel]
+
+    def publish(self, channel, event: dict):
+        for queue in self._subscribers.get(channel, ()):
+            if queue.full():
+                queue.get_nowait()  # Drop the oldest event for this slow subscriber
+            queue.put_nowait(event)
+
+    def close(self, channel):
+        """
+        Ends every open stream on `channel`, e.g. once its user or account is deleted.
+        """
+        self.publish(channel, _CLOSED)
+
+event_bus = EventBus()
+
+def publish_user_event(user_id: int, event_type: str, **data):
+    """
+    Publishes an event to the user's own channel and mirrors it on the admin channel.
+    """
+    event = {
+        "type": event_type,
+        "user_id": user_id,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        **data
+    }
+    event_bus.publish(user_id, event)
+    event_bus.publish(ADMIN_CHANNEL, event)
+
+async def stream_events(request, channel, expires_at: float = None):
+    """
+    Yields server-sent events for `channel` until the client disconnects, the channel is closed
+    or `expires_at` (the token's `exp`, a Unix timestamp) passes.
+    """
+    queue = event_bus.subscribe(channel)
+    try:
+        while not await request.is_disconnected():
+            timeout = KEEP_ALIVE_SECONDS
+            if expires_at is not None:
+                remaining = expires_at - time.time()
+                if remaining <= 0:
+                    # ✅ The token the stream was opened with is no longer valid, the client must log in again
+                    yield "event: token_expired\ndata: {}\n\n"
+                    return
+                timeout = min(timeout, remaining)
+
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event is _CLOSED:
+                return
+            yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+    finally:
+        event_bus.unsubscribe(channel, queue)
@@ -1,20 +1,61 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response, status
+from sqlalchemy import text
 from database import engine, SessionLocal
 import models
+import read_model
+import blockchain
+import outbox
+import archive
+from admission import admission_stats
 from routers import auth, admin, users
 from contextlib import asynccontextmanager
+import asyncio
 
-# Ensure database tables are created
-models.Base.metadata.create_all(bind=engine)
+# Readiness flags, flipped by the warm-up in lifespan (workers start "not ready")
+readiness = {"database": False, "blockchain": False}
+
+def warm_up_database():
+    # ✅ Create missing tables and open a pooled connection before any request needs one
+    models.Base.metadata.create_all(bind=engine)
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+    # ✅ Users created before the read model existed get their view row once, here
+    db = SessionLocal()
+    try:
+        read_model.backfill_account_views(db)
+    finally:
+        db.close()
+    readiness["database"] = True
+
+def warm_up_blockchain():
+    readiness["blockchain"] = blockchain.warm_up()
 
 # Lifespan Event (Manages DB Connections)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("🚀 FastAPI application starting...")
+    await asyncio.to_thread(warm_up_database)
+    await asyncio.to_thread(warm_up_blockchain)
+    if not readiness["blockchain"]:
+        print("⚠️ Blockchain node not reachable yet, the background health checks will keep retrying")
+
+    # ✅ Drain queued chain operations in the background (entries left over from a crash included)
+    background_jobs = [
+        asyncio.create_task(outbox.run_outbox_worker()),
+        asyncio.create_task(blockchain.run_health_checks())
+    ]
+    if archive.INTERVAL_SECONDS > 0:
+        background_jobs.append(asyncio.create_task(archive.run_archive_job()))
     yield
     print("🛑 FastAPI application shutting down...")
-    # Ensure DB session cleanup
-    SessionLocal().close()
+    for job in background_jobs:
+        job.cancel()
+    await asyncio.gather(*background_jobs, return_exceptions=True)
+    readiness["database"] = False
+    readiness["blockchain"] = False
+    # Close pooled DB connections
+    engine.dispose()
 
 # Create FastAPI App
 app = FastAPI(lifespan=lifespan)
@@ -24,7 +65,34 @@ app = FastAPI(lifespan=lifespan)
 def root():
     return {"message": "Welcome to our Blockchain application!"}
 
+# Liveness: the process is up and serving, nothing else is checked
+@app.get("/health/live", status_code=status.HTTP_200_OK)
+def liveness():
+    return {"status": "alive"}
+
+# Readiness: only true while the DB pool is warm and at least one RPC node is healthy
+@app.get("/health/ready", status_code=status.HTTP_200_OK)
+def readiness_check(response: Response):
+    # ✅ Answered from the background health checks, a probe never waits on an RPC node itself
+    readiness["blockchain"] = blockchain.is_healthy()
+
+    is_ready = all(readiness.values())
+    if not is_ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return {"status": "ready" if is_ready else "starting", "checks": readiness}
+
+# Health, latency and block height of every RPC endpoint
+@app.get("/health/rpc", status_code=status.HTTP_200_OK)
+def rpc_status():
+    return blockchain.get_router().status()
+
+# Queue depth and rejection counters per admission route group
+@app.get("/health/admission", status_code=status.HTTP_200_OK)
+def admission_metrics():
+    return admission_stats()
+
 # Register API Routers
 app.include_router(auth.router)
 app.include_router(admin.router)
-app.include_router(users.router)
\ No newline at end of file
+app.include_router(users.router)
@@ -1,6 +1,6 @@
 from database import Base
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Float, Enum
-from enums import BidStatus, InterestRate, Payments
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Float, Enum, Index
+from enums import BidStatus, InterestRate, Payments, OutboxStatus
 
 class Users(Base):
     __tablename__ = 'users'
@@ -18,7 +18,7 @@ class Account(Base):
     __tablename__ = 'account'
 
     account_id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
     balance = Column(Float, default=0.0, nullable=False)
     is_active = Column(Boolean, default=False, nullable=False)
     active_loan = Column(Boolean, default=False, nullable=False)
@@ -27,11 +27,95 @@ class Loans(Base):
     __tablename__ = 'loans'
 
     loan_id = Column(Integer, primary_key=True, index=True)
-    account_id = Column(Integer, ForeignKey('account.account_id', ondelete="CASCADE"), nullable=False)
+    account_id = Column(Integer, ForeignKey('account.account_id', ondelete="CASCADE"), nullable=False, index=True)
     amount = Column(Float, nullable=False)
     interest_rate = Column(Enum(InterestRate), nullable=False)
     duration_months = Column(Enum(Payments), nullable=False)  # Enum for durations
     start_date = Column(String, nullable=False)
     end_date = Column(String, nullable=False)
     remaining_balance = Column(Float, nullable=False)
-    status = Column(Enum(BidStatus), default=BidStatus.PENDING, nullable=False)
\ No newline at end of file
+    status = Column(Enum(BidStatus), default=BidStatus.PENDING, nullable=False)
+
+    # Overdue sweeps and archival filter on status + end_date. AUTOINCREMENT keeps SQLite from
+    # reusing the id of an archived loan.
+    __table_args__ = (Index('ix_loans_status_end_date', 'status', 'end_date'), {'sqlite_autoincrement': True})
+
+class LoanHistory(Base):
+    # Settled (PAID / REJECTED) loans moved out of `loans` by archive.py
+    __tablename__ = 'loan_history'
+
+    history_id = Column(Integer, primary_key=True, index=True)
+    loan_id = Column(Integer, nullable=False, index=True)  # Same id the loan had in `loans`
+    account_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=True, index=True)  # Kept so history survives account deletion
+    amount = Column(Float, nullable=False)
+    interest_rate = Column(Enum(InterestRate), nullable=False)
+    duration_months = Column(Enum(Payments), nullable=False)
+    start_date = Column(String, nullable=False)
+    end_date = Column(String, nullable=False)
+    remaining_balance = Column(Float, nullable=False)
+    status = Column(Enum(BidStatus), nullable=False)
+    archived_at = Column(String, nullable=False)
+
+class ChainOutbox(Base):
+    __tablename__ = 'chain_outbox'
+
+    outbox_id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)  # transfer, loan_disbursement, loan_repayment, penalty
+    loan_id = Column(Integer, nullable=True)
+    from_account_id = Column(Integer, nullable=True)
+    to_account_id = Column(Integer, nullable=True)
+    from_address = Column(String, nullable=False, index=True)
+    to_address = Column(String, nullable=False)
+    amount = Column(Float, nullable=False)
+    loan_balance_before = Column(Float, nullable=True)  # Restored on the loan if a penalty transfer fails
+    status = Column(Enum(OutboxStatus), default=OutboxStatus.PENDING, nullable=False, index=True)
+    nonce = Column(Integer, nullable=True)  # Reserved before sending so a retry reuses it
+    nonce_block = Column(Integer, nullable=True)  # Block number when the nonce was reserved
+    tx_hash = Column(String, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    rejections = Column(Integer, default=0, nullable=False)  # Attempts the node rejected (counted against the limit)
+    last_error = Column(String, nullable=True)
+    next_attempt_at = Column(String, nullable=False)
+    created_at = Column(String, nullable=False)
+    updated_at = Column(String, nullable=False)
+
+class AccountView(Base):
+    # Denormalized user -> account -> current loan row, maintained by read_model.py on every flush
+    __tablename__ = 'account_view'
+
+    user_id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, nullable=False)
+    role = Column(String, nullable=False)
+    public_key = Column(String, nullable=False)
+    account_id = Column(Integer, nullable=True)
+    balance = Column(Float, nullable=True)
+    is_active = Column(Boolean, nullable=True)
+    active_loan = Column(Boolean, nullable=True)
+    loan_id = Column(Integer, nullable=True)
+    loan_amount = Column(Float, nullable=True)
+    interest_rate = Column(Enum(InterestRate), nullable=True)
+    duration_months = Column(Enum(Payments), nullable=True)
+    start_date = Column(String, nullable=True)
+    end_date = Column(String, nullable=True)
+    remaining_balance = Column(Float, nullable=True)
+    loan_status = Column(Enum(BidStatus), nullable=True)
+
+class CreditFeatures(Base):
+    # Per-account risk features, updated incrementally by credit.py on every loan transition
+    __tablename__ = 'credit_features'
+
+    account_id = Column(Integer, primary_key=True, index=True)
+    loans_requested = Column(Integer, default=0, nullable=False)
+    loans_approved = Column(Integer, default=0, nullable=False)
+    loans_rejected = Column(Integer, default=0, nullable=False)
+    loans_repaid = Column(Integer, default=0, nullable=False)  # Paid off by the borrower
+    loans_defaulted = Column(Integer, default=0, nullable=False)  # Settled by the punish sweep
+    late_payoffs = Column(Integer, default=0, nullable=False)  # Repaid loans paid off after their end date
+    penalties_total = Column(Float, default=0.0, nullable=False)
+    total_borrowed = Column(Float, default=0.0, nullable=False)
+    total_repaid = Column(Float, default=0.0, nullable=False)
+    repayment_count = Column(Integer, default=0, nullable=False)
+    payoff_minutes_total = Column(Float, default=0.0, nullable=False)  # Approval to payoff, summed over repaid loans
+    outstanding_balance = Column(Float, default=0.0, nullable=False)  # Includes penalty shortfalls left unpaid
+    updated_at = Column(String, nullable=False)
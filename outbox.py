@@ -0,0 +1,403 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from database import SessionLocal
+from models import Account, Loans, ChainOutbox
+from enums import OutboxStatus, BidStatus
+import blockchain
+import clock
+import credit
+from events import publish_user_event
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Worker tuning (environment overridable)
+MAX_CONCURRENCY = int(os.getenv("OUTBOX_MAX_CONCURRENCY", "4"))
+# Attempts the node rejected; unreachable-node errors back off without counting
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+RECEIPT_TIMEOUT_SECONDS = int(os.getenv("OUTBOX_RECEIPT_TIMEOUT_SECONDS", "120"))
+# How long a claimed entry is hidden from other workers; must outlast a send plus the receipt wait
+LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", str(RECEIPT_TIMEOUT_SECONDS + 60)))
+# How many blocks past the nonce reservation are searched for a transaction sent before a crash
+NONCE_SCAN_BLOCKS = int(os.getenv("OUTBOX_NONCE_SCAN_BLOCKS", "1000"))
+
+OPEN_STATUSES = (OutboxStatus.PENDING, OutboxStatus.SENT)
+
+_wake_up = asyncio.Event()
+
+def _now():
+    return datetime.now().strftime(DATE_FORMAT)
+
+def enqueue_transfer(db, kind: str, from_account, to_account, from_address: str, to_address: str,
+                     amount: float, loan_id: int = None):
+    """
+    Records a chain transfer in the outbox as part of the caller's DB transaction.
+
+    Nothing is committed or sent here: the entry becomes visible to the worker together with
+    the business change that caused it. Account balances are moved optimistically and are
+    resynced from the chain once the worker confirms (or gives up on) the transfer.
+    """
+    now = _now()
+    entry = ChainOutbox(
+        kind=kind,
+        loan_id=loan_id,
+        from_account_id=from_account.account_id if from_account else None,
+        to_account_id=to_account.account_id if to_account else None,
+        from_address=from_address,
+        to_address=to_address,
+        amount=amount,
+        status=OutboxStatus.PENDING,
+        attempts=0,
+        rejections=0,
+        next_attempt_at=now,
+        created_at=clock.now().strftime(DATE_FORMAT),  # App clock, like the loan dates it is compared with
+        updated_at=now
+    )
+    db.add(entry)
+
+    if from_account:
+        from_account.balance -= amount
+    if to_account:
+        to_account.balance += amount
+
+    return entry
+
+def notify():
+    # ✅ Wake the worker right away instead of waiting for the next poll
+    _wake_up.set()
+
+def projected_balance(db, address: str, chain_balance) -> float:
+    """
+    Chain balance adjusted for transfers that are queued or in flight for `address`.
+    """
+    outgoing = db.query(func.coalesce(func.sum(ChainOutbox.amount), 0.0)).filter(
+        ChainOutbox.from_address == address, ChainOutbox.status.in_(OPEN_STATUSES)).scalar()
+    incoming = db.query(func.coalesce(func.sum(ChainOutbox.amount), 0.0)).filter(
+        ChainOutbox.to_address == address, ChainOutbox.status.in_(OPEN_STATUSES)).scalar()
+    return float(chain_balance) - outgoing + incoming
+
+### Chain calls (blocking, run in a worker thread) ###
+# Everything about a sender's transaction goes to the node pinned to that sender
+
+def _nonce_used(address: str, nonce: int) -> bool:
+    return blockchain.write(address, lambda web3: web3.eth.get_transaction_count(address)) > nonce
+
+def _next_nonce(address: str):
+    # The nonce plus the block it was reserved at, where a search for its transaction starts
+    return blockchain.write(address, lambda web3: (web3.eth.get_transaction_count(address, 'pending'),
+                                                   web3.eth.block_number))
+
+def _find_sent_transaction(entry):
+    """
+    Hash of the mined transaction that spent `entry.nonce`, if it is this entry's transfer
+    (same recipient and value). None when it is some other transaction or cannot be found.
+    """
+    def find(web3):
+        latest = web3.eth.block_number
+        first = entry.nonce_block if entry.nonce_block is not None else max(latest - NONCE_SCAN_BLOCKS, 0)
+        for number in range(first, min(latest, first + NONCE_SCAN_BLOCKS) + 1):
+            for transaction in web3.eth.get_block(number, full_transactions=True)['transactions']:
+                if transaction['from'].lower() != entry.from_address.lower() or transaction['nonce'] != entry.nonce:
+                    continue
+                if (transaction['to'] or '').lower() == entry.to_address.lower() and \
+                        transaction['value'] == web3.to_wei(entry.amount, 'ether'):
+                    return transaction['hash'].hex()
+                return None
+        return None
+
+    return blockchain.write(entry.from_address, find)
+
+def _send_transaction(from_address: str, to_address: str, amount: float, nonce: int) -> str:
+    chain_id = blockchain.get_chain_id()
+
+    def send(web3):
+        transaction = {
+            'from': from_address,
+            'to': to_address,
+            'value': web3.to_wei(amount, 'ether'),
+            'gas': 21000,
+            'gasPrice': web3.to_wei(1, 'gwei'),
+            'nonce': nonce,
+            'chainId': chain_id
+        }
+        return web3.eth.send_transaction(transaction).hex()
+
+    return blockchain.write(from_address, send)
+
+def _wait_for_receipt(from_address: str, tx_hash: str) -> bool:
+    receipt = blockchain.write(from_address, lambda web3: web3.eth.wait_for_transaction_receipt(
+        tx_hash, timeout=RECEIPT_TIMEOUT_SECONDS))
+    return receipt["status"] == 1
+
+def _read_balances(addresses) -> dict:
+    return blockchain.read(lambda web3: {
+        address: web3.from_wei(web3.eth.get_balance(address), 'ether') for address in addresses
+    })
+
+### Worker ###
+
+def _get_account(db, account_id):
+    return db.query(Account).filter(Account.account_id == account_id).first() if account_id else None
+
+def _compensate_loan(db, entry):
+    """
+    Undoes the loan change committed together with a transfer that failed (not committed).
+
+    A failed disbursement puts the loan back to PENDING for the admin to decide again. A failed
+    repayment or penalty gives the loan back the balance it was meant to settle, reopening it if
+    it had been marked PAID. Returns the loan, or None when the transfer was not tied to one.
+    """
+    if entry.loan_id is None:
+        return None
+
+    loan = db.query(Loans).filter(Loans.loan_id == entry.loan_id).first()
+    if loan is None:
+        print(f"⚠️ Loan {entry.loan_id} of failed outbox entry {entry.outbox_id} no longer exists")
+        return None
+
+    # The credit features counted the transition when it was committed, take it back as well
+    if entry.kind == "loan_disbursement":
+        # The borrower keeps active_loan, as for any pending request
+        if loan.status == BidStatus.APPROVED:
+            credit.revert_loan_decision(db, loan)
+            loan.status = BidStatus.PENDING
+    elif entry.kind == "loan_repayment":
+        credit.revert_repayment(db, loan, entry.amount, paid_off=loan.status == BidStatus.PAID,
+                                paid_at=datetime.strptime(entry.created_at, DATE_FORMAT))
+        loan.remaining_balance += entry.amount
+    elif entry.kind == "penalty" and entry.loan_balance_before is not None:
+        credit.revert_penalty(db, loan, entry.loan_balance_before, entry.amount)
+        loan.remaining_balance = entry.loan_balance_before
+
+    if entry.kind in ("loan_repayment", "penalty") and loan.remaining_balance > 0 and loan.status == BidStatus.PAID:
+        loan.status = BidStatus.APPROVED
+        account = _get_account(db, loan.account_id)
+        if account:
+            account.active_loan = True
+
+    return loan
+
+async def _fetch_chain_balances(entry):
+    try:
+        return await asyncio.to_thread(_read_balances, {entry.from_address, entry.to_address})
+    except Exception as e:
+        # Keep the optimistic balances, the next confirmed transfer will resync them
+        print(f"⚠️ Could not resync balances for outbox entry {entry.outbox_id}: {e}")
+        return None
+
+async def _may_have_been_sent(entry) -> bool:
+    """
+    Whether giving up on `entry` could refund money that moves anyway.
+
+    Once a nonce was reserved a send may have reached the node, so an entry (SENT ones above
+    all, where a receipt wait merely timed out) is only failed while its nonce is still unused on
+    chain. Otherwise it stays open and keeps retrying: the next attempt confirms it or picks up
+    its receipt.
+    """
+    if entry.nonce is None:
+        return False
+    try:
+        return await asyncio.to_thread(_nonce_used, entry.from_address, entry.nonce)
+    except Exception:
+        return True
+
+async def _park(db, entry, reason: str):
+    """
+    Takes an entry out of the queue for manual reconciliation (GET /admin/outbox?outbox_status=needs_review).
+
+    Nothing is refunded or confirmed: whether the money moved is exactly what is unknown.
+    """
+    entry.status = OutboxStatus.NEEDS_REVIEW
+    entry.last_error = reason
+    entry.updated_at = _now()
+    db.commit()
+    print(f"⚠️ Outbox entry {entry.outbox_id} needs manual reconciliation: {reason}")
+
+    account = _get_account(db, entry.from_account_id)
+    if account:
+        publish_user_event(account.user_id, "transfer_needs_review", outbox_id=entry.outbox_id, kind=entry.kind,
+                           loan_id=entry.loan_id, amount=entry.amount)
+
+async def _settle(db, entry, outbox_status: OutboxStatus, error: str = None):
+    # Read the chain before touching the session: no write transaction may stay open across an await
+    balances = await _fetch_chain_balances(entry) if outbox_status == OutboxStatus.CONFIRMED else None
+
+    entry.status = outbox_status
+    entry.last_error = error
+    entry.updated_at = _now()
+    loan = None
+
+    if outbox_status == OutboxStatus.CONFIRMED:
+        if balances is not None:
+            db.flush()  # So the projected balances no longer count this entry
+            for account_id, address in ((entry.from_account_id, entry.from_address), (entry.to_account_id, entry.to_address)):
+                account = _get_account(db, account_id)
+                if account:
+                    account.balance = projected_balance(db, address, balances[address])
+    else:
+        # ✅ The money never moved, undo the optimistic balance change from enqueue_transfer
+        from_account = _get_account(db, entry.from_account_id)
+        to_account = _get_account(db, entry.to_account_id)
+        if from_account:
+            from_account.balance += entry.amount
+        if to_account:
+            to_account.balance -= entry.amount
+        # ✅ ...and the loan change that was committed with it
+        loan = _compensate_loan(db, entry)
+
+    db.commit()
+
+    event_type = "transfer_confirmed" if outbox_status == OutboxStatus.CONFIRMED else "transfer_failed"
+    for account_id in (entry.from_account_id, entry.to_account_id):
+        account = _get_account(db, account_id)
+        if account:
+            publish_user_event(account.user_id, event_type, outbox_id=entry.outbox_id, kind=entry.kind,
+                               loan_id=entry.loan_id, from_account=entry.from_account_id,
+                               to_account=entry.to_account_id, amount=entry.amount,
+                               transaction_hash=entry.tx_hash)
+
+    if loan is not None:
+        account = _get_account(db, loan.account_id)
+        if account:
+            publish_user_event(account.user_id, "loan_status", loan_id=loan.loan_id, status=loan.status.value,
+                               remaining_balance=loan.remaining_balance)
+
+async def process_entry(outbox_id: int, session_factory=SessionLocal):
+    """
+    Sends one outbox entry (if it has not been sent yet) and waits for its receipt.
+
+    The nonce is stored before sending. If the process dies between sending and recording the
+    hash, the next attempt sees the nonce already used on chain and looks up the transaction
+    that used it instead of sending the money twice. If that transaction is not this transfer
+    (the sender spent the nonce elsewhere) the entry is parked for manual reconciliation.
+    """
+    db = session_factory()
+    try:
+        entry = db.query(ChainOutbox).filter(ChainOutbox.outbox_id == outbox_id).first()
+        if entry is None or entry.status not in OPEN_STATUSES:
+            return
+
+        # ✅ Lease the entry: only one worker (process) wins the compare-and-set on `attempts`, and
+        # moving next_attempt_at past the lease keeps everyone else from seeing it as due meanwhile
+        now = datetime.now()
+        claimed = db.query(ChainOutbox).filter(
+            ChainOutbox.outbox_id == outbox_id,
+            ChainOutbox.attempts == entry.attempts,
+            ChainOutbox.next_attempt_at <= now.strftime(DATE_FORMAT)
+        ).update({ChainOutbox.attempts: entry.attempts + 1,
+                  ChainOutbox.next_attempt_at: (now + timedelta(seconds=LEASE_SECONDS)).strftime(DATE_FORMAT),
+                  ChainOutbox.updated_at: _now()},
+                 synchronize_session=False)
+        db.commit()
+        if not claimed:
+            return
+        db.refresh(entry)
+
+        try:
+            if entry.tx_hash is None and entry.nonce is not None and \
+                    await asyncio.to_thread(_nonce_used, entry.from_address, entry.nonce):
+                # ✅ A used nonce only proves *some* transaction went out, find out whether it was ours
+                entry.tx_hash = await asyncio.to_thread(_find_sent_transaction, entry)
+                if entry.tx_hash is None:
+                    await _park(db, entry, f"Nonce {entry.nonce} was used by a transaction that is not this transfer")
+                    return
+                entry.status = OutboxStatus.SENT
+                db.commit()
+
+            if entry.tx_hash is None:
+                if entry.nonce is None:
+                    entry.nonce, entry.nonce_block = await asyncio.to_thread(_next_nonce, entry.from_address)
+                    db.commit()
+
+                try:
+                    entry.tx_hash = await asyncio.to_thread(_send_transaction, entry.from_address, entry.to_address,
+                                                            entry.amount, entry.nonce)
+                except Exception as e:
+                    if not blockchain.is_transport_error(e):
+                        # The node refused the transaction (e.g. the nonce was spent elsewhere meanwhile),
+                        # so it did not use the nonce: reserve a fresh one next time
+                        entry.nonce = None
+                        entry.nonce_block = None
+                        db.commit()
+                    raise
+                entry.status = OutboxStatus.SENT
+                db.commit()
+
+            if await asyncio.to_thread(_wait_for_receipt, entry.from_address, entry.tx_hash):
+                await _settle(db, entry, OutboxStatus.CONFIRMED)
+            else:
+                # A mined but reverted transfer used its nonce, retrying cannot succeed
+                await _settle(db, entry, OutboxStatus.FAILED, "Transaction reverted on chain")
+
+        except Exception as e:
+            db.rollback()
+            entry = db.query(ChainOutbox).filter(ChainOutbox.outbox_id == outbox_id).first()
+            # ✅ An unreachable node says nothing about the transfer, only rejections use up attempts
+            if not blockchain.is_transport_error(e):
+                entry.rejections += 1
+            if entry.rejections >= MAX_ATTEMPTS and not await _may_have_been_sent(entry):
+                await _settle(db, entry, OutboxStatus.FAILED, str(e))
+                return
+            # ✅ Exponential backoff, capped at one minute
+            backoff = timedelta(seconds=min(2 ** entry.attempts, 60))
+            entry.last_error = str(e)
+            entry.next_attempt_at = (datetime.now() + backoff).strftime(DATE_FORMAT)
+            entry.updated_at = _now()
+            db.commit()
+    finally:
+        db.close()
+
+async def drain_outbox(session_factory=SessionLocal, max_concurrency: int = MAX_CONCURRENCY,
+                       batch_size: int = BATCH_SIZE) -> int:
+    """
+    Processes due outbox entries with at most `max_concurrency` in flight.
+
+    Only the oldest open entry of each sender is taken per pass, so one address never has two
+    transactions racing for the same nonce and its transfers land in the order they were queued.
+    Returns the number of entries processed.
+    """
+    db = session_factory()
+    try:
+        open_entries = db.query(ChainOutbox.outbox_id, ChainOutbox.from_address, ChainOutbox.next_attempt_at).filter(
+            ChainOutbox.status.in_(OPEN_STATUSES)).order_by(ChainOutbox.outbox_id).limit(batch_size * 4).all()
+    finally:
+        db.close()
+
+    now = _now()
+    heads = {}
+    for outbox_id, from_address, next_attempt_at in open_entries:
+        if from_address not in heads:
+            heads[from_address] = (outbox_id, next_attempt_at)
+    due = [outbox_id for outbox_id, next_attempt_at in heads.values() if next_attempt_at <= now][:batch_size]
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def bounded(outbox_id):
+        async with semaphore:
+            await process_entry(outbox_id, session_factory)
+
+    await asyncio.gather(*(bounded(outbox_id) for outbox_id in due), return_exceptions=True)
+    return len(due)
+
+async def run_outbox_worker():
+    """
+    Background loop started from the app lifespan; drains the outbox until cancelled.
+    """
+    while True:
+        try:
+            processed = await drain_outbox()
+        except Exception as e:
+            print(f"⚠️ Outbox drain failed: {e}")
+            processed = 0
+
+        if processed:
+            continue
+
+        _wake_up.clear()
+        try:
+            await asyncio.wait_for(_wake_up.wait(), timeout=POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,138 @@
+import os
+from itertools import chain
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import Users, Account, Loans, AccountView
+from enums import BidStatus
+from cache import TTLCache
+
+# Snapshots served to the request path, keyed by user id
+account_view_cache = TTLCache(
+    max_size=int(os.getenv("ACCOUNT_VIEW_CACHE_SIZE", "10000")),
+    ttl_seconds=float(os.getenv("ACCOUNT_VIEW_CACHE_TTL_SECONDS", "30"))
+)
+
+_TRACKED = (Users, Account, Loans)
+_CHANGED_KEY = "account_view_changed"
+_INVALIDATE_KEY = "account_view_invalidate"
+
+LIVE_STATUSES = (BidStatus.PENDING, BidStatus.APPROVED)
+
+def _snapshot(view: AccountView) -> dict:
+    return {column.name: getattr(view, column.name) for column in AccountView.__table__.columns}
+
+def _user_id_of(session, obj):
+    if isinstance(obj, Users):
+        return obj.id
+    if isinstance(obj, Account):
+        return obj.user_id
+    return session.query(Account.user_id).filter(Account.account_id == obj.account_id).scalar()
+
+def current_loan(session, account_id: int):
+    """
+    The loan `/user/my-loan` reports: the live (pending/approved) one if any, else the latest.
+    """
+    return session.query(Loans).filter(Loans.account_id == account_id).order_by(
+        Loans.status.in_(LIVE_STATUSES).desc(), Loans.loan_id.desc()).first()
+
+def rebuild_account_view(session, user_id: int):
+    """
+    Recomputes the view row for one user from Users, Account and Loans (not committed).
+    """
+    with session.no_autoflush:
+        user = session.query(Users).filter(Users.id == user_id).first()
+        view = session.query(AccountView).filter(AccountView.user_id == user_id).first()
+
+        if user is None:
+            if view is not None:
+                session.delete(view)
+            return
+
+        if view is None:
+            view = AccountView(user_id=user_id)
+            session.add(view)
+
+        account = session.query(Account).filter(Account.user_id == user_id).first()
+        loan = current_loan(session, account.account_id) if account else None
+
+        view.username = user.username
+        view.role = user.role
+        view.public_key = user.public_key
+        view.account_id = account.account_id if account else None
+        view.balance = account.balance if account else None
+        view.is_active = account.is_active if account else None
+        view.active_loan = account.active_loan if account else None
+        view.loan_id = loan.loan_id if loan else None
+        view.loan_amount = loan.amount if loan else None
+        view.interest_rate = loan.interest_rate if loan else None
+        view.duration_months = loan.duration_months if loan else None
+        view.start_date = loan.start_date if loan else None
+        view.end_date = loan.end_date if loan else None
+        view.remaining_balance = loan.remaining_balance if loan else None
+        view.loan_status = loan.status if loan else None
+
+### Session hooks: keep the view in step with every write path ###
+
+@event.listens_for(Session, "before_flush")
+def _collect_changes(session, flush_context, instances):
+    changed = session.info.setdefault(_CHANGED_KEY, [])
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, _TRACKED):
+            changed.append(obj)
+
+@event.listens_for(Session, "after_flush_postexec")
+def _rebuild_changed_views(session, flush_context):
+    changed = session.info.pop(_CHANGED_KEY, [])
+    if not changed:
+        return
+
+    with session.no_autoflush:
+        user_ids = {_user_id_of(session, obj) for obj in changed}
+    user_ids.discard(None)
+
+    # The rebuilt rows are flushed by the next pass of the same commit
+    for user_id in user_ids:
+        rebuild_account_view(session, user_id)
+    session.info.setdefault(_INVALIDATE_KEY, set()).update(user_ids)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_cache(session):
+    for user_id in session.info.pop(_INVALIDATE_KEY, ()):
+        account_view_cache.invalidate(user_id)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop(_CHANGED_KEY, None)
+    session.info.pop(_INVALIDATE_KEY, None)
+
+### Read path ###
+
+def get_account_view(db, user_id: int):
+    """
+    Returns the user's denormalized row as a dict (cached), or None if the user does not exist.
+
+    Treat the result as read-only and as possibly a few seconds old: use it for lookups and
+    pre-checks, and re-check on the row you actually write.
+    """
+    snapshot = account_view_cache.get(user_id)
+    if snapshot is not None:
+        return snapshot
+
+    view = db.query(AccountView).filter(AccountView.user_id == user_id).first()
+    if view is None:
+        return None
+
+    snapshot = _snapshot(view)
+    account_view_cache.set(user_id, snapshot)
+    return snapshot
+
+def backfill_account_views(db) -> int:
+    """
+    Builds view rows for users that predate the read model. Returns how many were built.
+    """
+    missing = db.query(Users.id).outerjoin(AccountView, AccountView.user_id == Users.id).filter(
+        AccountView.user_id.is_(None)).all()
+    for (user_id,) in missing:
+        rebuild_account_view(db, user_id)
+    db.commit()
+    return len(missing)
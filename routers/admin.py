@@ -1,13 +1,21 @@
-from fastapi import Depends, HTTPException, status, APIRouter, Path, BackgroundTasks
-from models import Users, Account, Loans
+from fastapi import Depends, HTTPException, status, APIRouter, Path, Query, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse
+from models import Users, Account, Loans, ChainOutbox, LoanHistory
 from database import SessionLocal
 from typing import Annotated
 from sqlalchemy.orm import Session
 from .auth import get_current_user
-from enums import BidStatus
-from .users import TransferRequest, transfer_eth, get_account_balance, web3_ganache
-from datetime import datetime, timedelta
+from enums import BidStatus, OutboxStatus
+from .users import TransferRequest, get_account_balance, chain_admission
+from admission import route_group
+from events import ADMIN_CHANNEL, event_bus, publish_user_event, stream_events
+import outbox
+import archive
+import credit
+from datetime import timedelta
+import clock
 import os
+import asyncio
 
 router = APIRouter(
     prefix='/admin',
@@ -24,6 +32,9 @@ def get_db():
 db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
+# One archival run at a time, a second request is turned away instead of queued
+archive_admission = Depends(route_group("archive", max_concurrent=1, max_waiting=0, retry_after=30))
+
 ### End Points ###
 @router.get("/users", status_code=status.HTTP_200_OK)
 async def read_all_users(user: user_dependency, db: db_dependency):
@@ -62,6 +73,7 @@ async def delete_user(user: user_dependency, db: db_dependency, user_id: int = P
         db.delete(user_account_to_delete)
 
     db.commit()  # Single commit for both operations
+    event_bus.close(user_id)  # ✅ End the deleted user's open event streams
 
     return {"message": f"User {user_id} and associated account deleted successfully"}
 
@@ -84,7 +96,7 @@ async def delete_loan(user: user_dependency, db: db_dependency, loan_id: int = P
     return {"message": f"Loan number {loan_id}  deleted successfully"}
 
 
-@router.put("/approve-loan/{loan_id}", status_code=status.HTTP_200_OK)
+@router.put("/approve-loan/{loan_id}", status_code=status.HTTP_200_OK, dependencies=[chain_admission])
 async def approve_loan(loan_id: int, user: user_dependency, db: db_dependency, approve: bool):
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Only admin can approve or reject loans")
@@ -113,49 +125,48 @@ async def approve_loan(loan_id: int, user: user_dependency, db: db_dependency, a
     if not borrower_profile:
         raise HTTPException(status_code=404, detail="User's profile not found")
 
+    # ✅ Borrower's credit features, for the admin's decision (one cached lookup)
+    credit_features = credit.get_credit_features(db, borrower_account.account_id)
+
     if approve:
         # ✅ Ensure admin has enough balance to transfer the loan amount
         if admin_account.balance < loan.amount:
             raise HTTPException(status_code=400, detail="Admin does not have enough balance to approve this loan")
 
-        # ✅ Transfer ETH from admin to borrower using transfer_eth
-        transfer_request = TransferRequest(
-            to_account=borrower_account.account_id,
-            amount=loan.amount
-        )
-
-        transfer_response = await transfer_eth(user, db, transfer_request)  # Call the existing transfer function
-
-        if "transaction_hash" not in transfer_response:
-            raise HTTPException(status_code=500, detail="Loan transfer failed on the blockchain")
-
-        new_admin_balance = get_account_balance(user.get("public_key"))
-        new_borrower_balance = get_account_balance(borrower_profile.public_key)
+        # ✅ Queue the transfer from admin to borrower, committed together with the approval
+        entry = outbox.enqueue_transfer(db, "loan_disbursement", admin_account, borrower_account,
+                                        user.get("public_key"), borrower_profile.public_key, loan.amount,
+                                        loan_id=loan.loan_id)
 
         # ✅ Update Loan End Time to extend from approval time
-        new_end_date = (datetime.now() + timedelta(minutes=loan.duration_months.value)).strftime("%Y-%m-%d %H:%M:%S")
+        new_end_date = (clock.now() + timedelta(minutes=loan.duration_months.value)).strftime("%Y-%m-%d %H:%M:%S")
         loan.end_date = new_end_date  # ✅ Update loan end time
 
-        # ✅ If transfer succeeds, update database balances
+        credit.record_loan_decision(db, loan, approved=True)
         loan.status = BidStatus.APPROVED
-        borrower_account.balance = new_borrower_balance  # ✅ Borrower receives the loan amount
-        admin_account.balance = new_admin_balance  # ✅ Admin's balance decreases
         borrower_account.active_loan = True  # ✅ Mark borrower as having an active loan
 
         db.commit()
         db.refresh(loan)
         db.refresh(borrower_account)
         db.refresh(admin_account)
+        db.refresh(entry)
+        outbox.notify()
+
+        publish_user_event(borrower_account.user_id, "loan_status", loan_id=loan.loan_id, status=loan.status.value)
 
         return {
-            "message": f"Loan approved. {loan.amount} transferred from admin to borrower.",
+            "message": f"Loan approved. Transfer of {loan.amount} from admin to borrower queued.",
             "new_balance_borrower": borrower_account.balance,
             "new_balance_admin": admin_account.balance,
-            "transaction_hash": transfer_response["transaction_hash"]
+            "outbox_id": entry.outbox_id,
+            "transaction_status": entry.status.value,
+            "credit_features": credit_features
         }
 
     else:
         # ❌ If loan is rejected, reset borrower's active_loan status
+        credit.record_loan_decision(db, loan, approved=False)
         loan.status = BidStatus.REJECTED
         borrower_account.active_loan = False
 
@@ -163,7 +174,9 @@ async def approve_loan(loan_id: int, user: user_dependency, db: db_dependency, a
         db.refresh(loan)
         db.refresh(borrower_account)
 
-        return {"message": "Loan rejected and account status updated"}
+        publish_user_event(borrower_account.user_id, "loan_status", loan_id=loan.loan_id, status=loan.status.value)
+
+        return {"message": "Loan rejected and account status updated", "credit_features": credit_features}
 
 
 @router.get("/admin/missed-loans", status_code=status.HTTP_200_OK)
@@ -171,7 +184,7 @@ async def get_all_missed_loans(user: user_dependency, db: db_dependency):
     if user is None or user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Only admin can check overdue loans")
 
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now = clock.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # ✅ Fetch all overdue loans (where end_date has passed and status is still APPROVED)
     overdue_loans = db.query(Loans).filter(Loans.end_date < now, Loans.status == BidStatus.APPROVED).all()
@@ -188,8 +201,8 @@ async def get_all_missed_loans(user: user_dependency, db: db_dependency):
                 "loan_id": loan.loan_id,
                 "user_id": account.user_id,
                 "remaining_balance": loan.remaining_balance,
-                "penalty": loan.remaining_balance * 0.10,
-                "total_due": loan.remaining_balance + (loan.remaining_balance * 0.10),
+                "penalty": loan.remaining_balance * credit.PENALTY_RATE,
+                "total_due": loan.remaining_balance + (loan.remaining_balance * credit.PENALTY_RATE),
                 "end_date": loan.end_date,
                 "status": loan.status.value
             })
@@ -199,12 +212,12 @@ async def get_all_missed_loans(user: user_dependency, db: db_dependency):
         "overdue_loans": overdue_loans_list
     }
 
-@router.post("/admin/punish-missed-payments", status_code=status.HTTP_200_OK)
+@router.post("/admin/punish-missed-payments", status_code=status.HTTP_200_OK, dependencies=[chain_admission])
 async def punish_missed_payments(user: user_dependency, db: db_dependency):
     if user is None or user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Only admin can take actions on overdue loans")
 
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now = clock.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # ✅ Fetch all overdue loans (where end_date has passed and status is still APPROVED)
     overdue_loans = db.query(Loans).filter(Loans.end_date < now, Loans.status == BidStatus.APPROVED).all()
@@ -217,41 +230,47 @@ async def punish_missed_payments(user: user_dependency, db: db_dependency):
     if not admin_account:
         raise HTTPException(status_code=404, detail="Admin's account not found")
 
-    punished_loans_list = []
-
+    # ✅ Find each borrower's account and profile
+    borrowers = []
     for loan in overdue_loans:
-        # ✅ Find the borrower's account and profile
         current_account = db.query(Account).filter(Account.account_id == loan.account_id).first()
         current_user_profile = db.query(Users).filter(Users.id == current_account.user_id).first() if current_account else None
 
         if not current_account or not current_user_profile:
             continue  # Skip if account or user profile is missing
+        borrowers.append((loan, current_account, current_user_profile))
+
+    # ✅ Read every borrower's chain balance in one worker thread, before any row is changed
+    chain_balances = await asyncio.to_thread(
+        lambda: {profile.public_key: get_account_balance(profile.public_key) for _, _, profile in borrowers})
+
+    punished_loans_list = []
 
-        # ✅ Update borrower's balance from blockchain
-        current_account.balance = get_account_balance(current_user_profile.public_key)
+    for loan, current_account, current_user_profile in borrowers:
+        # ✅ Update borrower's balance from blockchain (minus transfers still queued)
+        current_account.balance = outbox.projected_balance(db, current_user_profile.public_key,
+                                                           chain_balances[current_user_profile.public_key])
 
         # ✅ Calculate penalty (10% of remaining balance)
-        penalty = loan.remaining_balance * 0.10
+        penalty = loan.remaining_balance * credit.PENALTY_RATE
         total_due = loan.remaining_balance + penalty
 
         if total_due > current_account.balance:
             # If the borrower does not have enough balance, take whatever is left
             total_due = current_account.balance  # Take all remaining balance
 
-        # ✅ Transfer ETH from borrower to admin using transfer_eth
-        transfer_request = TransferRequest(
-            to_account=admin_account.account_id,
-            amount=total_due
-        )
+        # ✅ Queue the transfer from borrower to admin, committed together with the loan update
+        entry = None
+        if total_due > 0:
+            transfer_request = TransferRequest(
+                to_account=admin_account.account_id,
+                amount=total_due
+            )
+            entry = secure_transfer_to_admin(current_user_profile, db, transfer_request, loan_id=loan.loan_id)
+            entry.loan_balance_before = loan.remaining_balance
 
-        transfer_response = await secure_transfer_to_admin(current_user_profile, db, transfer_request)
-
-        if "transaction_hash" not in transfer_response:
-            continue  # Skip this loan if blockchain transfer fails
-
-        # ✅ Update borrower's and admin's balances from blockchain
-        current_account.balance = get_account_balance(current_user_profile.public_key)
-        admin_account.balance = get_account_balance(user.get("public_key"))
+        original_due = loan.remaining_balance
+        credit.record_penalty(db, loan, original_due, penalty, total_due)
 
         # ✅ Mark loan as paid
         loan.remaining_balance = 0
@@ -263,33 +282,90 @@ async def punish_missed_payments(user: user_dependency, db: db_dependency):
         punished_loans_list.append({
             "loan_id": loan.loan_id,
             "user_id": current_account.user_id,
-            "original_due": loan.remaining_balance,
+            "original_due": original_due,
             "penalty": penalty,
             "total_deducted": total_due,
-            "transaction_hash": transfer_response["transaction_hash"],
-            "updated_borrower_balance": current_account.balance,  # ✅ Updated from blockchain
-            "updated_admin_balance": admin_account.balance  # ✅ Updated from blockchain
+            "entry": entry,
+            "updated_borrower_balance": current_account.balance,
+            "updated_admin_balance": admin_account.balance
         })
 
     db.commit()
     db.refresh(admin_account)
+    outbox.notify()
+
+    for punished_loan in punished_loans_list:
+        entry = punished_loan.pop("entry")
+        punished_loan["outbox_id"] = entry.outbox_id if entry else None
+        publish_user_event(punished_loan["user_id"], "loan_status", loan_id=punished_loan["loan_id"],
+                           status=BidStatus.PAID.value, penalty=punished_loan["penalty"])
 
     return {
         "message": "Overdue loans punished successfully.",
         "punished_loans": punished_loans_list
     }
 
-async def secure_transfer_to_admin(user: user_dependency, db: db_dependency, transfer_request: TransferRequest):
+@router.post("/archive-loans", status_code=status.HTTP_200_OK, dependencies=[archive_admission])
+async def archive_loans(user: user_dependency, batch_size: int = Query(default=archive.BATCH_SIZE, gt=0),
+                        retention_minutes: int = Query(default=archive.RETENTION_MINUTES, ge=0)):
+    if user is None or user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized Access")
+
+    # ✅ Move PAID / REJECTED loans out of the hot table in batches, off the event loop
+    archived = await asyncio.to_thread(archive.archive_once, batch_size, retention_minutes)
+
+    return {"message": f"{archived} settled loans archived", "archived": archived}
+
+@router.get("/loan-history", status_code=status.HTTP_200_OK)
+async def read_loan_history(user: user_dependency, db: db_dependency, user_id: int = None):
+    if user is None or user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized Access")
+
+    query = db.query(LoanHistory)
+    if user_id is not None:
+        query = query.filter(LoanHistory.user_id == user_id)
+    return query.order_by(LoanHistory.loan_id).all()
+
+@router.get("/credit-features/{account_id}", status_code=status.HTTP_200_OK)
+async def read_credit_features(user: user_dependency, db: db_dependency, account_id: int = Path(gt=0)):
+    if user is None or user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized Access")
+
+    if not db.query(Account).filter(Account.account_id == account_id).first():
+        raise HTTPException(status_code=404, detail="Account not found")
+
+    return credit.get_credit_features(db, account_id)
+
+@router.get("/outbox", status_code=status.HTTP_200_OK)
+async def read_outbox(user: user_dependency, db: db_dependency, outbox_status: OutboxStatus = None):
+    if user is None or user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized Access")
+
+    query = db.query(ChainOutbox)
+    if outbox_status is not None:
+        query = query.filter(ChainOutbox.status == outbox_status)
+    return query.order_by(ChainOutbox.outbox_id).all()
+
+@router.get("/events", status_code=status.HTTP_200_OK)
+async def admin_events(user: user_dependency, request: Request):
+    if user is None or user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized Access")
+
+    # ✅ Every user's loan and transfer updates, mirrored on one channel
+    return StreamingResponse(stream_events(request, ADMIN_CHANNEL, expires_at=user.get("exp")), media_type="text/event-stream")
+
+def secure_transfer_to_admin(user, db, transfer_request: TransferRequest, loan_id: int = None):
     """
-    Securely transfers ETH from the current user to the admin.
+    Queues an ETH transfer from the given user to the admin.
 
     Parameters:
-    - `user`: The authenticated user (dict with `id` and `public_key`).
+    - `user`: The borrower's `Users` row (needs `id` and `public_key`).
     - `db`: Database session.
     - `transfer_request`: Contains `amount` (ETH to transfer).
+    - `loan_id`: Loan the transfer settles, if any.
 
     Returns:
-    - A dict with transaction details if successful.
+    - The outbox entry. Nothing is committed; the caller commits it with its own changes.
     """
 
     # ✅ Fetch the sender's account (current user)
@@ -308,40 +384,5 @@ async def secure_transfer_to_admin(user: user_dependency, db: db_dependency, tra
     if not admin_profile:
         raise HTTPException(status_code=404, detail="Admin's profile not found")
 
-    # ✅ Update sender's balance from blockchain
-    sender_account.balance = get_account_balance(user.public_key)
-
-    # ✅ Prepare blockchain transaction (Transfer from USER to ADMIN)
-    transaction = {
-        'from': user.public_key,  # ✅ Sender's Ethereum address
-        'to': admin_profile.public_key,  # ✅ Admin's Ethereum address
-        'value': web3_ganache.to_wei(transfer_request.amount, 'ether'),  # Convert ETH to Wei
-        'gas': 21000,
-        'gasPrice': web3_ganache.to_wei(1, 'gwei'),
-        'nonce': web3_ganache.eth.get_transaction_count(user.public_key),
-        'chainId': web3_ganache.eth.chain_id
-    }
-
-    try:
-        # ✅ Send the transaction
-        tx_hash = web3_ganache.eth.send_transaction(transaction)
-        web3_ganache.eth.wait_for_transaction_receipt(tx_hash)
-
-        # ✅ Update sender's and admin's balances from blockchain (AFTER transfer)
-        sender_account.balance = get_account_balance(user.public_key)
-        admin_account.balance = get_account_balance(admin_profile.public_key)
-
-        # ✅ Commit changes to database
-        db.commit()
-        db.refresh(sender_account)
-        db.refresh(admin_account)
-
-        return {
-            "message": "ETH transferred successfully from user to admin",
-            "transaction_hash": tx_hash.hex(),
-            "user_new_balance": sender_account.balance,
-            "admin_new_balance": admin_account.balance
-        }
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Blockchain transfer failed: {str(e)}")
+    return outbox.enqueue_transfer(db, "penalty", sender_account, admin_account, user.public_key,
+                                   admin_profile.public_key, transfer_request.amount, loan_id=loan_id)
@@ -76,7 +76,8 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
         if not username or not user_id:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
 
-        return {'username': username, 'id': user_id, 'role': user_role, 'public_key': public_key}
+        return {'username': username, 'id': user_id, 'role': user_role, 'public_key': public_key,
+                'exp': payload.get('exp')}
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
 
@@ -1,23 +1,27 @@
-from fastapi import Depends, HTTPException, status, APIRouter
+from fastapi import Depends, HTTPException, status, APIRouter, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from models import Users, Account, Loans
+from models import Users, Account, Loans, ChainOutbox, LoanHistory
 from database import SessionLocal
 from typing import Annotated
 from sqlalchemy.orm import Session
 from .auth import get_current_user
-from web3 import Web3
-from datetime import datetime, timedelta
+import blockchain
+from datetime import timedelta
+import asyncio
+import clock
 from enums import InterestRate, BidStatus, Payments
-import os
+from events import event_bus, publish_user_event, stream_events
+import outbox
+from read_model import get_account_view
+from admission import route_group
+import credit
 
 router = APIRouter(
     prefix='/user',
     tags=['user']
 )
 
-ganache_url = os.getenv("GANACHE_URL")
-web3_ganache=Web3(Web3.HTTPProvider(ganache_url))
-
 def get_db():
     db = SessionLocal()
     try:
@@ -28,17 +32,21 @@ def get_db():
 db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
+# Admission control per route group: chain-bound calls get a small pool so they cannot starve reads
+chain_admission = Depends(route_group("chain", max_concurrent=8, max_waiting=32, wait_timeout=10))
+read_admission = Depends(route_group("read", max_concurrent=64, max_waiting=256, wait_timeout=2))
+
 class SetUpAccount(BaseModel):
     balance: float
     is_active: bool = True
 
 def get_account_balance(user_public_key):
-    balance_wei = web3_ganache.eth.get_balance(user_public_key)
-    return web3_ganache.from_wei(balance_wei, 'ether')
+    # ✅ Served by the fastest healthy RPC node
+    return blockchain.read(lambda web3: web3.from_wei(web3.eth.get_balance(user_public_key), 'ether'))
 
                                                   #### End Points ####
 
-@router.post("/set-up-account", status_code=status.HTTP_201_CREATED)
+@router.post("/set-up-account", status_code=status.HTTP_201_CREATED, dependencies=[chain_admission])
 async def set_up_account(user: user_dependency, db: db_dependency): # account_set_up: SetUpAccount):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
@@ -49,7 +57,8 @@ async def set_up_account(user: user_dependency, db: db_dependency): # account_se
         raise HTTPException(status_code=400, detail='Account already exists')
 
     user_public_key = user.get("public_key")
-    real_balance = get_account_balance(user_public_key)
+    # ✅ The RPC call runs in a worker thread, so a slow node holds an admission slot, not the event loop
+    real_balance = await asyncio.to_thread(get_account_balance, user_public_key)
 
     account_set_up_new = SetUpAccount(balance=real_balance, is_active=True)
 
@@ -62,7 +71,7 @@ async def set_up_account(user: user_dependency, db: db_dependency): # account_se
 
 
 @router.delete("/delete-account", status_code=status.HTTP_200_OK)
-async def set_up_account(user: user_dependency, db: db_dependency):
+async def delete_account(user: user_dependency, db: db_dependency):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
 
@@ -73,6 +82,7 @@ async def set_up_account(user: user_dependency, db: db_dependency):
 
     db.delete(existing_account_to_delete)
     db.commit()  # Single commit for both operations
+    event_bus.close(user.get("id"))  # ✅ No account, nothing left to stream
 
     return {"message": "Account Deleted successfully", "user_id": user.get("id")}
 
@@ -82,7 +92,7 @@ class TransferRequest(BaseModel):
     to_account: int = Field(gt=0, description="Recipient account ID")
     amount: float = Field(gt=0, description="Amount to transfer")
 
-@router.post("/transfer-eth", status_code=status.HTTP_201_CREATED)
+@router.post("/transfer-eth", status_code=status.HTTP_201_CREATED, dependencies=[chain_admission])
 async def transfer_eth(user: user_dependency, db: db_dependency, transfer_request: TransferRequest):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
@@ -98,26 +108,38 @@ async def transfer_eth(user: user_dependency, db: db_dependency, transfer_reques
 
     user_to_account = db.query(Users).filter(to_account.user_id == Users.id).first()
 
-    # Simulate Blockchain Transfer (To be replaced with a proper signing mechanism)
-    transaction = {
-        'from': user.get("public_key"),
-        'to': user_to_account.public_key,
-        'value': web3_ganache.to_wei(transfer_request.amount, 'ether'),
-        'gas': 21000,
-        'gasPrice': web3_ganache.to_wei(1, 'gwei'),
-        'nonce': web3_ganache.eth.get_transaction_count(user.get("public_key")),
-        'chainId': 1337
-    }
+    # ✅ Record the transfer in the outbox with the balance change, the worker sends it on chain
+    entry = outbox.enqueue_transfer(db, "transfer", from_account, to_account, user.get("public_key"),
+                                    user_to_account.public_key, transfer_request.amount)
+    db.commit()
+    db.refresh(entry)
+    outbox.notify()
 
-    tx_hash = web3_ganache.eth.send_transaction(transaction)
-    web3_ganache.eth.wait_for_transaction_receipt(tx_hash)
+    return {"message": "ETH transfer queued", "outbox_id": entry.outbox_id, "transaction_status": entry.status.value}
 
-    # Update balances in the database
-    from_account.balance -= transfer_request.amount
-    to_account.balance += transfer_request.amount
-    db.commit()
+@router.get("/transfer-status/{outbox_id}", status_code=status.HTTP_200_OK, dependencies=[read_admission])
+async def get_transfer_status(user: user_dependency, db: db_dependency, outbox_id: int):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+
+    account = db.query(Account).filter(Account.user_id == user.get("id")).first()
+    if not account:
+        raise HTTPException(status_code=404, detail="User does not have an account")
 
-    return {"message": "ETH transferred successfully", "transaction_hash": tx_hash.hex()}
+    entry = db.query(ChainOutbox).filter(ChainOutbox.outbox_id == outbox_id).first()
+    if not entry or account.account_id not in (entry.from_account_id, entry.to_account_id):
+        raise HTTPException(status_code=404, detail="Transfer not found")
+
+    return {
+        "outbox_id": entry.outbox_id,
+        "kind": entry.kind,
+        "loan_id": entry.loan_id,
+        "amount": entry.amount,
+        "status": entry.status.value,
+        "transaction_hash": entry.tx_hash,
+        "attempts": entry.attempts,
+        "last_error": entry.last_error
+    }
 
 
                                             ### Loan Management ###
@@ -132,6 +154,7 @@ async def request_loan(user: user_dependency, db: db_dependency, loan_request: L
     if user is None:
         raise HTTPException(status_code=401, detail="Authentication Failed")
 
+    # ✅ Checked on the row we write, never on the cached view (it may lag another worker's commit)
     account = db.query(Account).filter(Account.user_id == user.get("id")).first()
 
     if not account:
@@ -143,6 +166,13 @@ async def request_loan(user: user_dependency, db: db_dependency, loan_request: L
     if loan_request.amount > account.balance:
         raise HTTPException(status_code=400, detail="Requested loan amount exceeds account balance")
 
+    # ✅ Risk checks from the account's cached credit features (no scan of the loan history)
+    refusal = credit.assess_loan_request(credit.get_credit_features(db, account.account_id))
+    if refusal:
+        raise HTTPException(status_code=400, detail=refusal)
+
+    credit.record_loan_requested(db, account.account_id)
+
     # ✅ Calculate total repayment (Loan + Interest)
     interest_multiplier = 1 + (loan_request.interest_rate.value / 100)
     total_repayment = loan_request.amount * interest_multiplier
@@ -152,8 +182,8 @@ async def request_loan(user: user_dependency, db: db_dependency, loan_request: L
     installment_amount = total_repayment / num_payments # --> How much loaner needs to pay every month
 
     # ✅ Change from months to minutes for testing
-    start_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    end_date = (datetime.now() + timedelta(minutes=loan_request.duration_months.value)).strftime("%Y-%m-%d %H:%M:%S")
+    start_date = clock.now().strftime("%Y-%m-%d %H:%M:%S")
+    end_date = (clock.now() + timedelta(minutes=loan_request.duration_months.value)).strftime("%Y-%m-%d %H:%M:%S")
 
     new_loan = Loans(
         account_id=account.account_id,
@@ -173,6 +203,8 @@ async def request_loan(user: user_dependency, db: db_dependency, loan_request: L
     db.refresh(new_loan)
     db.refresh(account)
 
+    publish_user_event(account.user_id, "loan_status", loan_id=new_loan.loan_id, status=new_loan.status.value)
+
     return {
         "message": "Loan request submitted successfully",
         "loan_id": new_loan.loan_id,
@@ -183,7 +215,7 @@ async def request_loan(user: user_dependency, db: db_dependency, loan_request: L
 class RepayLoanRequest(BaseModel):
     user_payment: float
 
-@router.post("/repay-loan/{loan_id}")
+@router.post("/repay-loan/{loan_id}", dependencies=[chain_admission])
 async def repay_loan(user: user_dependency, db: db_dependency, loan_id: int, request: RepayLoanRequest):
     if user is None:
         raise HTTPException(status_code=401, detail="Authentication Failed")
@@ -204,43 +236,35 @@ async def repay_loan(user: user_dependency, db: db_dependency, loan_id: int, req
     if not account:
         raise HTTPException(status_code=404, detail="Borrower's account not found")
 
+    if account.user_id != user.get("id"):
+        raise HTTPException(status_code=403, detail="You can only repay your own loan")
+
     if user_payment > account.balance:
         raise HTTPException(status_code=400, detail="Insufficient balance for repayment")
 
-    # ✅ Fetch the admin's account (loan provider - Bank)
-    admin_account = db.query(Account).filter(Account.user_id == 1).first()
+    # ✅ Fetch the admin User and account (loan provider - Bank) from the read model
+    admin_view = get_account_view(db, 1)
+    if not admin_view:
+        raise HTTPException(status_code=404, detail="Admin User not found")
+
+    admin_account = db.query(Account).filter(Account.account_id == admin_view["account_id"]).first() \
+        if admin_view["account_id"] is not None else None
     if not admin_account:
         raise HTTPException(status_code=404, detail="Admin's account not found")
 
-    # ✅ Fetch the admin User (loan provider - Bank)
-    admin_user = db.query(Users).filter(Users.id == 1).first()
-    if not admin_user:
-        raise HTTPException(status_code=404, detail="Admin User not found")
-
     # ✅ checking if user paid more then he needs if user
     if loan.remaining_balance < user_payment:
         raise HTTPException(status_code=404, detail=f"User need to pay only {loan.remaining_balance}eth !")
 
-    # ✅ Transfer ETH from borrower to admin using transfer_eth FIRST
-    transfer_request = TransferRequest(
-        to_account=admin_account.account_id,
-        amount=user_payment
-    )
-
-    transfer_response = await transfer_eth(user, db, transfer_request)  # Call the existing transfer function
-    if "transaction_hash" not in transfer_response:
-        raise HTTPException(status_code=500, detail="Loan transfer failed on the blockchain")
-
-    new_user_balance = get_account_balance(user.get("public_key"))
-    new_admin_balance = get_account_balance(admin_user.public_key)
+    # ✅ Queue the transfer from borrower to admin in the same transaction as the loan update
+    entry = outbox.enqueue_transfer(db, "loan_repayment", account, admin_account, user.get("public_key"),
+                                    admin_view["public_key"], user_payment, loan_id=loan.loan_id)
 
     # ✅ Update Loan Details
-    account.balance = new_user_balance
+    paid_off = loan.remaining_balance - user_payment <= 0
+    credit.record_repayment(db, loan, user_payment, paid_off)
     loan.remaining_balance -= user_payment
 
-    # ✅ Add amount to admin's balance
-    admin_account.balance = new_admin_balance
-
     # ✅ Prevent negative balance
     if loan.remaining_balance < 0:
         loan.remaining_balance = 0
@@ -254,39 +278,72 @@ async def repay_loan(user: user_dependency, db: db_dependency, loan_id: int, req
     db.commit()  # ✅ Save changes to the database
     db.refresh(loan)
     db.refresh(account)
-    db.refresh(admin_account)
+    db.refresh(entry)
+    outbox.notify()
+
+    publish_user_event(account.user_id, "loan_repayment", loan_id=loan.loan_id, amount=user_payment,
+                       remaining_balance=loan.remaining_balance, status=loan.status.value)
 
     return {
-        "message": "Repayment successful",
+        "message": "Repayment queued",
         "remaining_balance": loan.remaining_balance,
-        "transaction_hash": transfer_response["transaction_hash"]
+        "outbox_id": entry.outbox_id,
+        "transaction_status": entry.status.value
     }
 
-@router.get("/my-loan", status_code=status.HTTP_200_OK)
+@router.get("/my-loan", status_code=status.HTTP_200_OK, dependencies=[read_admission])
 async def get_my_loan(user: user_dependency, db: db_dependency):
     if user is None:
         raise HTTPException(status_code=401, detail="Authentication Failed")
 
-    # ✅ Find the user's account
-    account = db.query(Account).filter(Account.user_id == user.get("id")).first()
+    # ✅ Account and current loan come from one denormalized (cached) row
+    view = get_account_view(db, user.get("id"))
 
-    if not account:
+    if not view or view["account_id"] is None:
         raise HTTPException(status_code=404, detail="User does not have an account")
 
-    # ✅ Find the loan linked to the user's account
-    loan = db.query(Loans).filter(Loans.account_id == account.account_id).first()
-
-    if not loan:
+    if view["loan_id"] is None:
         raise HTTPException(status_code=404, detail="No loan found for this user")
 
     return {
-        "loan_id": loan.loan_id,
-        "amount": loan.amount,
-        "interest_rate": loan.interest_rate.value,  # Convert Enum to value
-        "duration_months": loan.duration_months.value,  # Convert Enum to value
-        "start_date": loan.start_date,
-        "end_date": loan.end_date,
-        "remaining_balance": loan.remaining_balance,
-        "status": loan.status.value,  # Convert Enum to string
-        "borrower_active_loan": account.active_loan  # Show if borrower still has an active loan
+        "loan_id": view["loan_id"],
+        "amount": view["loan_amount"],
+        "interest_rate": view["interest_rate"].value,  # Convert Enum to value
+        "duration_months": view["duration_months"].value,  # Convert Enum to value
+        "start_date": view["start_date"],
+        "end_date": view["end_date"],
+        "remaining_balance": view["remaining_balance"],
+        "status": view["loan_status"].value,  # Convert Enum to string
+        "borrower_active_loan": view["active_loan"]  # Show if borrower still has an active loan
     }
+
+@router.get("/loan-history", status_code=status.HTTP_200_OK, dependencies=[read_admission])
+async def get_loan_history(user: user_dependency, db: db_dependency):
+    if user is None:
+        raise HTTPException(status_code=401, detail="Authentication Failed")
+
+    # ✅ Settled loans that were archived out of the live loans table
+    history = db.query(LoanHistory).filter(LoanHistory.user_id == user.get("id")).order_by(LoanHistory.loan_id).all()
+
+    return [
+        {
+            "loan_id": loan.loan_id,
+            "amount": loan.amount,
+            "interest_rate": loan.interest_rate.value,
+            "duration_months": loan.duration_months.value,
+            "start_date": loan.start_date,
+            "end_date": loan.end_date,
+            "remaining_balance": loan.remaining_balance,
+            "status": loan.status.value,
+            "archived_at": loan.archived_at
+        }
+        for loan in history
+    ]
+
+@router.get("/events", status_code=status.HTTP_200_OK)
+async def user_events(user: user_dependency, request: Request):
+    if user is None:
+        raise HTTPException(status_code=401, detail="Authentication Failed")
+
+    # ✅ Push channel for this user's loan and transfer updates (replaces polling /my-loan)
+    return StreamingResponse(stream_events(request, user.get("id"), expires_at=user.get("exp")), media_type="text/event-stream")
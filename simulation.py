@@ -0,0 +1,463 @@
+"""
+Offline loan-lifecycle simulator for capacity planning.
+
+Drives synthetic borrowers through the real router functions and models (no HTTP):
+
+    set_up_account -> request_loan -> approve_loan -> repay_loan / overdue -> punish_missed_payments
+
+against an in-process chain and a temporary SQLite database, on an accelerated clock (loan
+terms are minutes standing in for months, as in request_loan). For every stage it reports
+wall time, RPC calls, SQL statements and rows touched.
+
+Usage:
+    python simulation.py --borrowers 2000 --overdue-ratio 0.2 --reject-ratio 0.05
+    python simulation.py --borrowers 500 --nodes 3 --down-nodes 1   # RPC routing and failover
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from decimal import Decimal
+from fastapi import HTTPException
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import blockchain
+import clock
+import outbox
+import archive
+import read_model  # Registers the read-model session hooks
+from database import Base
+from models import Users, ChainOutbox
+from enums import InterestRate, Payments, OutboxStatus
+from routers import users, admin
+
+WEI_PER_UNIT = {'ether': 10 ** 18, 'gwei': 10 ** 9, 'wei': 1}
+
+# Returned by a stage call that had nothing to do; not counted as an operation
+SKIPPED = object()
+
+### In-process chain ###
+
+class _InMemoryEth:
+    def __init__(self, chain, node=None):
+        self._chain = chain
+        self._node = node
+
+    def _count(self, method):
+        if self._node is not None:
+            self._node.call(method)
+        self._chain.count(method)
+
+    @property
+    def chain_id(self):
+        self._count("eth_chainId")
+        return self._chain.CHAIN_ID
+
+    @property
+    def block_number(self):
+        self._count("eth_blockNumber")
+        with self._chain.lock:
+            return len(self._chain.blocks) - 1
+
+    def get_block(self, number, full_transactions=False):
+        self._count("eth_getBlockByNumber")
+        with self._chain.lock:
+            return {"number": number, "transactions": list(self._chain.blocks[number])}
+
+    def get_balance(self, address):
+        self._count("eth_getBalance")
+        with self._chain.lock:
+            return self._chain.balances.get(address, 0)
+
+    def get_transaction_count(self, address, block_identifier='latest'):
+        self._count("eth_getTransactionCount")
+        with self._chain.lock:
+            return self._chain.nonces.get(address, 0)
+
+    def send_transaction(self, transaction):
+        self._count("eth_sendTransaction")
+        return self._chain.apply(transaction)
+
+    def wait_for_transaction_receipt(self, tx_hash, timeout=120):
+        self._count("eth_getTransactionReceipt")
+        with self._chain.lock:
+            return self._chain.receipts[tx_hash]
+
+class InMemoryChain:
+    """
+    Stand-in for the Ganache node with the small part of the Web3 API this app uses.
+
+    Every transaction is mined immediately, in a block of its own. Nonces, balances and gas are
+    enforced the way the node would enforce them.
+    """
+
+    CHAIN_ID = 1337
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.nonces = {}
+        self.receipts = {}
+        self.blocks = [[]]  # Genesis block first
+        self.rpc_calls = Counter()
+        self.eth = _InMemoryEth(self)
+
+    def count(self, method):
+        with self.lock:
+            self.rpc_calls[method] += 1
+
+    def is_connected(self):
+        return True
+
+    def to_wei(self, amount, unit):
+        return int(Decimal(str(amount)) * WEI_PER_UNIT[unit])
+
+    def from_wei(self, value, unit):
+        return Decimal(value) / WEI_PER_UNIT[unit]
+
+    def fund(self, address, ether):
+        self.balances[address] = self.balances.get(address, 0) + self.to_wei(ether, 'ether')
+
+    def apply(self, transaction):
+        sender = transaction['from']
+        cost = transaction['value'] + transaction['gas'] * transaction['gasPrice']
+        with self.lock:
+            if transaction['nonce'] != self.nonces.get(sender, 0):
+                raise ValueError(f"Invalid nonce {transaction['nonce']} for {sender}")
+            if self.balances.get(sender, 0) < cost:
+                raise ValueError(f"Insufficient funds for {sender}")
+            self.balances[sender] -= cost
+            self.balances[transaction['to']] = self.balances.get(transaction['to'], 0) + transaction['value']
+            self.nonces[sender] = transaction['nonce'] + 1
+            tx_hash = os.urandom(32)
+            self.receipts[tx_hash.hex()] = {"status": 1}
+            self.blocks.append([{"hash": tx_hash, "from": sender, "to": transaction['to'],
+                                 "value": transaction['value'], "nonce": transaction['nonce']}])
+            return tx_hash
+
+class InMemoryNode:
+    """
+    One stand-in RPC node in front of a shared `InMemoryChain`, for exercising the RPC router.
+
+    A node marked `down` refuses every call, like an unreachable endpoint.
+    """
+
+    def __init__(self, chain: InMemoryChain, name: str, down: bool = False):
+        self.chain = chain
+        self.name = name
+        self.down = down
+        self.rpc_calls = 0
+        self.eth = _InMemoryEth(chain, self)
+
+    def call(self, method):
+        if self.down:
+            raise ConnectionError(f"Node {self.name} is down")
+        self.rpc_calls += 1
+
+    def is_connected(self):
+        return not self.down
+
+    def to_wei(self, amount, unit):
+        return self.chain.to_wei(amount, unit)
+
+    def from_wei(self, value, unit):
+        return self.chain.from_wei(value, unit)
+
+### Accelerated clock ###
+
+class SimulatedClock:
+    def __init__(self):
+        self.current = datetime.now()
+
+    def now(self):
+        return self.current
+
+    def advance(self, minutes: float):
+        self.current += timedelta(minutes=minutes)
+
+### Measurement ###
+
+class DbCounters:
+    def __init__(self, engine):
+        self.statements = 0
+        self.rows_written = 0
+        self.rows_loaded = 0
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        if not statement.lstrip().upper().startswith("SELECT") and cursor.rowcount > 0:
+            self.rows_written += cursor.rowcount
+
+    def on_load(self, session, instance):
+        self.rows_loaded += 1
+
+class StageReport:
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, name, operations, rejected, seconds, rpc_calls, statements, rows_written, rows_loaded):
+        self.stages[name] = {
+            "operations": operations,
+            "rejected": rejected,
+            "wall_seconds": round(seconds, 3),
+            "ms_per_operation": round(seconds * 1000 / operations, 3) if operations else 0.0,
+            "rpc_calls": rpc_calls,
+            "rpc_per_operation": round(rpc_calls / operations, 2) if operations else 0.0,
+            "sql_statements": statements,
+            "rows_written": rows_written,
+            "rows_loaded": rows_loaded
+        }
+
+    def print_table(self, borrowers):
+        header = f"{'stage':<16}{'ops':>8}{'rejected':>10}{'wall s':>10}{'ms/op':>10}{'rpc':>10}{'rpc/op':>8}{'sql':>10}{'written':>10}{'loaded':>10}"
+        print(header)
+        print("-" * len(header))
+        totals = Counter()
+        for name, stage in self.stages.items():
+            print(f"{name:<16}{stage['operations']:>8}{stage['rejected']:>10}{stage['wall_seconds']:>10.3f}"
+                  f"{stage['ms_per_operation']:>10.3f}{stage['rpc_calls']:>10}{stage['rpc_per_operation']:>8.2f}"
+                  f"{stage['sql_statements']:>10}{stage['rows_written']:>10}{stage['rows_loaded']:>10}")
+            for key in ("wall_seconds", "rpc_calls", "sql_statements", "rows_written", "rows_loaded"):
+                totals[key] += stage[key]
+        print("-" * len(header))
+        print(f"Per borrower lifecycle: {totals['wall_seconds'] * 1000 / borrowers:.3f} ms, "
+              f"{totals['rpc_calls'] / borrowers:.2f} RPC calls, {totals['sql_statements'] / borrowers:.2f} SQL statements, "
+              f"{totals['rows_written'] / borrowers:.2f} rows written, {totals['rows_loaded'] / borrowers:.2f} rows loaded")
+
+### Simulation ###
+
+class Simulation:
+    def __init__(self, borrowers: int, overdue_ratio: float, reject_ratio: float, seed: int, db_path: str,
+                 nodes: int = 1, down_nodes: int = 0):
+        self.borrowers = borrowers
+        self.overdue_ratio = overdue_ratio
+        self.reject_ratio = reject_ratio
+        self.random = random.Random(seed)
+
+        self.engine = create_engine(f"sqlite:///{db_path}", connect_args={'check_same_thread': False})
+        self.session_factory = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        Base.metadata.create_all(bind=self.engine)
+
+        self.chain = InMemoryChain()
+        # Several stand-in nodes share one chain; the first `down_nodes` of them refuse every call
+        self.nodes = [InMemoryNode(self.chain, f"node-{index}", down=index < down_nodes) for index in range(nodes)]
+        self.clock = SimulatedClock()
+        self.db_counters = DbCounters(self.engine)
+        event.listen(self.session_factory, "loaded_as_persistent", self.db_counters.on_load)
+        self.report = StageReport()
+
+        self.admin_user = None
+        self.borrower_users = []
+        self.loans = {}  # user id -> loan id
+        self.failed_transfers_seen = 0
+
+    async def _call(self, router_function, user, *args):
+        """
+        Runs one router call in its own session, like a request would. Returns None when rejected.
+        """
+        db = self.session_factory()
+        try:
+            return await router_function(user, db, *args)
+        except HTTPException:
+            return None
+        finally:
+            db.close()
+
+    async def _stage(self, name, run):
+        """
+        Measures one lifecycle stage. `run` returns (operations, rejected).
+        """
+        rpc_before = sum(self.chain.rpc_calls.values())
+        statements, written, loaded = (self.db_counters.statements, self.db_counters.rows_written,
+                                       self.db_counters.rows_loaded)
+        started = time.perf_counter()
+
+        operations, rejected = await run()
+
+        self.report.record(name, operations, rejected, time.perf_counter() - started,
+                           sum(self.chain.rpc_calls.values()) - rpc_before,
+                           self.db_counters.statements - statements,
+                           self.db_counters.rows_written - written,
+                           self.db_counters.rows_loaded - loaded)
+
+    @staticmethod
+    async def _each(calls):
+        operations, rejected = 0, 0
+        for call in calls:
+            result = await call
+            if result is SKIPPED:
+                continue
+            operations += 1
+            if result is None:
+                rejected += 1
+        return operations, rejected
+
+    async def _settle(self):
+        # Drain the outbox until nothing is left open; one operation per processed entry
+        processed = 0
+        while True:
+            batch = await outbox.drain_outbox(session_factory=self.session_factory)
+            processed += batch
+            if batch:
+                continue
+
+            db = self.session_factory()
+            try:
+                still_open = db.query(ChainOutbox).filter(ChainOutbox.status.in_(outbox.OPEN_STATUSES)).count()
+                failed = db.query(ChainOutbox).filter(ChainOutbox.status == OutboxStatus.FAILED).count()
+            finally:
+                db.close()
+            if not still_open:
+                newly_failed, self.failed_transfers_seen = failed - self.failed_transfers_seen, failed
+                return processed, newly_failed
+            await asyncio.sleep(0.1)  # Entries are backing off after a failed attempt
+
+    def _seed_users(self):
+        db = self.session_factory()
+        try:
+            admin_user = Users(id=1, email="bank@sim.local", username="bank", first_name="Sim", last_name="Bank",
+                               hashed_password="-", role="admin", public_key="0xbank")
+            db.add(admin_user)
+            for index in range(self.borrowers):
+                db.add(Users(email=f"borrower{index}@sim.local", username=f"borrower{index}", first_name="Sim",
+                             last_name=f"Borrower{index}", hashed_password="-", role="borrower",
+                             public_key=f"0xborrower{index:08d}"))
+            db.commit()
+
+            self.admin_user = {"username": "bank", "id": 1, "role": "admin", "public_key": "0xbank"}
+            self.borrower_users = [
+                {"username": user.username, "id": user.id, "role": user.role, "public_key": user.public_key}
+                for user in db.query(Users).filter(Users.id != 1).order_by(Users.id).all()
+            ]
+        finally:
+            db.close()
+
+        self.chain.fund("0xbank", 100 * self.borrowers + 1000)
+        for user in self.borrower_users:
+            self.chain.fund(user["public_key"], self.random.uniform(20, 100))
+
+    async def run(self):
+        previous_clock = clock.set_clock(self.clock.now)
+        if len(self.nodes) > 1:
+            previous_router = blockchain.set_endpoints([blockchain.RpcEndpoint(node.name, node) for node in self.nodes])
+        else:
+            previous_router = blockchain.set_web3(self.chain)
+        try:
+            # Like the lifespan warm-up: health-check the nodes before the first request
+            blockchain.warm_up()
+            await self._run()
+        finally:
+            clock.set_clock(previous_clock)
+            blockchain.set_web3(previous_router)
+            self.engine.dispose()
+
+    async def _run(self):
+        self._seed_users()
+        everyone = [self.admin_user] + self.borrower_users
+
+        await self._stage("set_up_account", lambda: self._each(
+            self._call(users.set_up_account, user) for user in everyone))
+
+        async def request(user):
+            loan_request = users.LoanRequest(
+                amount=self.random.randint(1, 15),
+                duration_months=self.random.choice(list(Payments)),
+                interest_rate=self.random.choice(list(InterestRate))
+            )
+            response = await self._call(users.request_loan, user, loan_request)
+            if response:
+                self.loans[user["id"]] = response["loan_id"]
+            return response
+
+        await self._stage("request_loan", lambda: self._each(request(user) for user in self.borrower_users))
+
+        approved = []
+
+        async def decide(user):
+            approve = self.random.random() >= self.reject_ratio
+            db = self.session_factory()
+            try:
+                response = await admin.approve_loan(self.loans[user["id"]], self.admin_user, db, approve)
+            except HTTPException:
+                return None
+            finally:
+                db.close()
+            if approve:
+                approved.append(user)
+            return response
+
+        await self._stage("approve_loan", lambda: self._each(
+            decide(user) for user in self.borrower_users if user["id"] in self.loans))
+        await self._stage("settle_disburse", self._settle)
+
+        payers = [user for user in approved if self.random.random() >= self.overdue_ratio]
+        max_installments = max(payments.value for payments in Payments)
+
+        async def pay_installment(user, round_number):
+            db = self.session_factory()
+            try:
+                view = read_model.get_account_view(db, user["id"])
+            finally:
+                db.close()
+            installments_left = view["duration_months"].value - round_number
+            if installments_left <= 0 or not view["remaining_balance"]:
+                return SKIPPED  # Paid off or no installments left this month
+            payment = view["remaining_balance"] if installments_left == 1 else view["remaining_balance"] / installments_left
+            return await self._call(users.repay_loan, user, self.loans[user["id"]],
+                                    users.RepayLoanRequest(user_payment=payment))
+
+        # One installment per simulated month (a minute, as in request_loan), settled before the next one
+        for round_number in range(max_installments):
+            await self._stage(f"repay_month_{round_number + 1}", lambda: self._each(
+                pay_installment(user, round_number) for user in payers))
+            await self._stage(f"settle_month_{round_number + 1}", self._settle)
+            self.clock.advance(1)
+
+        # Let every loan still open run past its term, then sweep
+        self.clock.advance(max_installments + 1)
+        await self._stage("punish_overdue", lambda: self._each(
+            [self._call(admin.punish_missed_payments, self.admin_user)]))
+        await self._stage("settle_penalty", self._settle)
+
+        async def archive_all():
+            db = self.session_factory()
+            try:
+                archived = archive.archive_settled_loans(db, retention_minutes=0)
+            finally:
+                db.close()
+            return archived, 0
+
+        await self._stage("archive", archive_all)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate loan lifecycles against the real router code.")
+    parser.add_argument("--borrowers", type=int, default=1000)
+    parser.add_argument("--overdue-ratio", type=float, default=0.2, help="Share of approved borrowers who never repay")
+    parser.add_argument("--reject-ratio", type=float, default=0.05, help="Share of loan requests the admin rejects")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--nodes", type=int, default=1, help="Stand-in RPC nodes behind the RPC router")
+    parser.add_argument("--down-nodes", type=int, default=0, help="How many of those nodes are unreachable")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON instead of a table")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        simulation = Simulation(args.borrowers, args.overdue_ratio, args.reject_ratio, args.seed,
+                                os.path.join(temp_dir, "simulation.db"), args.nodes, args.down_nodes)
+        asyncio.run(simulation.run())
+
+    if args.json:
+        print(json.dumps(simulation.report.stages, indent=2))
+    else:
+        simulation.report.print_table(args.borrowers)
+        if len(simulation.nodes) > 1:
+            print("RPC calls per node: " + ", ".join(f"{node.name}={node.rpc_calls}" for node in simulation.nodes))
+
+if __name__ == "__main__":
+    main()
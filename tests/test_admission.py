@@ -0,0 +1,56 @@
+import asyncio
+from fastapi import HTTPException
+from admission import AdmissionLimiter
+
+def test_burst_beyond_the_queue_is_rejected_at_once():
+    async def burst():
+        limiter = AdmissionLimiter("burst", max_concurrent=2, max_waiting=2, wait_timeout=0.2, retry_after=1)
+
+        async def request():
+            try:
+                await limiter.acquire()
+            except HTTPException as e:
+                return e.status_code
+            try:
+                await asyncio.sleep(0.5)  # Longer than the wait timeout, so queued requests time out
+            finally:
+                limiter.release()
+            return 200
+
+        started = asyncio.get_running_loop().time()
+        tasks = [asyncio.create_task(request()) for _ in range(20)]
+        await asyncio.sleep(0)
+        rejected_at_once = limiter.rejected_queue_full
+        results = await asyncio.gather(*tasks)
+        return limiter, rejected_at_once, results, asyncio.get_running_loop().time() - started
+
+    limiter, rejected_at_once, results, elapsed = asyncio.run(burst())
+
+    assert rejected_at_once == 16
+    assert results.count(429) == 16
+    assert results.count(503) == 2
+    assert results.count(200) == 2
+    assert limiter.peak_waiting == 2
+    assert limiter.in_flight == 0 and limiter.waiting == 0
+    assert elapsed < 1
+
+def test_queued_request_takes_the_freed_slot():
+    async def run():
+        limiter = AdmissionLimiter("queue", max_concurrent=1, max_waiting=1, wait_timeout=1, retry_after=1)
+        order = []
+
+        async def request(name, hold):
+            await limiter.acquire()
+            order.append(name)
+            try:
+                await asyncio.sleep(hold)
+            finally:
+                limiter.release()
+
+        await asyncio.gather(request("first", 0.1), request("second", 0))
+        return limiter, order
+
+    limiter, order = asyncio.run(run())
+    assert order == ["first", "second"]
+    assert limiter.admitted == 2
+    assert limiter.rejected_queue_full == limiter.rejected_timeout == 0
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import clock
+import credit
+from database import Base
+from enums import BidStatus, InterestRate, Payments
+from models import Loans
+
+DATE_FORMAT = credit.DATE_FORMAT
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'credit.db'}")
+    Base.metadata.create_all(bind=engine)
+    previous = clock.set_clock(lambda: NOW)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    clock.set_clock(previous)
+    engine.dispose()
+
+def approved_loan(db, amount=10.0, term=Payments.ONE, end_date=NOW + timedelta(minutes=1)):
+    loan = Loans(account_id=1, amount=amount, interest_rate=InterestRate.RATE_1, duration_months=term,
+                 start_date=NOW.strftime(DATE_FORMAT), end_date=end_date.strftime(DATE_FORMAT),
+                 remaining_balance=amount, status=BidStatus.PENDING)
+    db.add(loan)
+    db.flush()
+    credit.record_loan_decision(db, loan, approved=True)
+    loan.status = BidStatus.APPROVED
+    return loan
+
+def features(db):
+    db.commit()
+    credit.feature_cache.invalidate(1)
+    return credit.get_credit_features(db, 1)
+
+def test_penalty_shortfall_stays_outstanding_and_blocks_new_loans(db):
+    loan = approved_loan(db)
+    credit.record_penalty(db, loan, original_due=10.0, penalty=1.0, collected=3.0)
+
+    assert features(db)["outstanding_balance"] == pytest.approx(8.0)
+    assert credit.assess_loan_request(features(db)) == "Loan refused: too much is still owed on previous loans"
+
+    credit.revert_penalty(db, loan, original_due=10.0, collected=3.0)
+    snapshot = features(db)
+    assert snapshot["outstanding_balance"] == pytest.approx(10.0)
+    assert snapshot["loans_defaulted"] == 0 and snapshot["penalties_total"] == pytest.approx(0.0)
+
+def test_late_payoffs_are_counted_against_the_loan_end_date(db):
+    on_time = approved_loan(db, end_date=NOW + timedelta(minutes=1))
+    credit.record_repayment(db, on_time, 10.0, paid_off=True)
+    late = approved_loan(db, end_date=NOW - timedelta(minutes=4))  # One-minute loan, paid four minutes late
+    credit.record_repayment(db, late, 10.0, paid_off=True)
+
+    assert features(db)["late_payoffs"] == 1
+    assert credit.assess_loan_request(features(db)) is None
+
+    another_late = approved_loan(db, end_date=NOW - timedelta(minutes=1))
+    credit.record_repayment(db, another_late, 10.0, paid_off=True)
+    assert credit.assess_loan_request(features(db)) == "Loan refused: 2 previous loans were paid off after their end date"
+
+    credit.revert_repayment(db, another_late, 10.0, paid_off=True, paid_at=NOW)
+    snapshot = features(db)
+    assert snapshot["late_payoffs"] == 1 and snapshot["loans_repaid"] == 2
@@ -0,0 +1,149 @@
+import asyncio
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import blockchain
+import outbox
+import read_model  # Registers the read-model session hooks
+from database import Base
+from enums import OutboxStatus
+from models import Users, Account, ChainOutbox
+from simulation import InMemoryChain, InMemoryNode
+
+SENDER = "0xsender"
+RECIPIENT = "0xrecipient"
+OTHER = "0xother"
+
+@pytest.fixture
+def chain():
+    chain = InMemoryChain()
+    chain.fund(SENDER, 100)
+    previous = blockchain.set_web3(chain)
+    yield chain
+    blockchain.set_web3(previous)
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'outbox.db'}", connect_args={'check_same_thread': False})
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+def queue_transfer(session_factory, amount=5.0):
+    db = session_factory()
+    try:
+        for index, address in enumerate((SENDER, RECIPIENT), start=1):
+            db.add(Users(id=index, email=f"{index}@test", username=f"user{index}", first_name="Test",
+                         last_name="User", hashed_password="-", role="borrower", public_key=address))
+            db.add(Account(account_id=index, user_id=index, balance=100.0 if address == SENDER else 0.0,
+                           is_active=True))
+        db.flush()
+        sender, recipient = db.get(Account, 1), db.get(Account, 2)
+        entry = outbox.enqueue_transfer(db, "transfer", sender, recipient, SENDER, RECIPIENT, amount)
+        db.commit()
+        return entry.outbox_id
+    finally:
+        db.close()
+
+def load(session_factory, outbox_id):
+    db = session_factory()
+    try:
+        entry = db.get(ChainOutbox, outbox_id)
+        db.expunge(entry)
+        return entry
+    finally:
+        db.close()
+
+def retry_now(session_factory, outbox_id):
+    db = session_factory()
+    try:
+        db.get(ChainOutbox, outbox_id).next_attempt_at = outbox._now()
+        db.commit()
+    finally:
+        db.close()
+
+def spend_nonce(chain, nonce):
+    chain.apply({'from': SENDER, 'to': OTHER, 'value': chain.to_wei(1, 'ether'), 'gas': 21000,
+                 'gasPrice': chain.to_wei(1, 'gwei'), 'nonce': nonce})
+
+def test_nonce_spent_before_send_reserves_a_fresh_one(chain, session_factory, monkeypatch):
+    outbox_id = queue_transfer(session_factory)
+    reserve = outbox._next_nonce
+
+    def reserve_then_spend_elsewhere(address):
+        nonce, block = reserve(address)
+        spend_nonce(chain, nonce)  # The sender's own wallet uses it before the worker sends
+        return nonce, block
+
+    monkeypatch.setattr(outbox, "_next_nonce", reserve_then_spend_elsewhere)
+    asyncio.run(outbox.process_entry(outbox_id, session_factory))
+
+    entry = load(session_factory, outbox_id)
+    assert entry.status == OutboxStatus.PENDING
+    assert entry.nonce is None
+    assert chain.balances.get(RECIPIENT, 0) == 0
+
+    monkeypatch.setattr(outbox, "_next_nonce", reserve)
+    retry_now(session_factory, outbox_id)
+    asyncio.run(outbox.process_entry(outbox_id, session_factory))
+
+    entry = load(session_factory, outbox_id)
+    assert entry.status == OutboxStatus.CONFIRMED
+    assert entry.nonce == 1
+    assert chain.balances[RECIPIENT] == chain.to_wei(5, 'ether')
+
+def test_nonce_used_by_another_transaction_is_not_confirmed(chain, session_factory):
+    outbox_id = queue_transfer(session_factory)
+
+    # Nonce reserved, then the process died before sending; meanwhile the wallet spent the nonce
+    db = session_factory()
+    entry = db.get(ChainOutbox, outbox_id)
+    entry.nonce, entry.nonce_block = 0, 0
+    db.commit()
+    db.close()
+    spend_nonce(chain, 0)
+
+    asyncio.run(outbox.process_entry(outbox_id, session_factory))
+
+    entry = load(session_factory, outbox_id)
+    assert entry.status == OutboxStatus.NEEDS_REVIEW
+    assert entry.tx_hash is None
+    assert chain.balances.get(RECIPIENT, 0) == 0
+
+def test_transfer_sent_before_a_crash_is_confirmed_once(chain, session_factory):
+    outbox_id = queue_transfer(session_factory)
+
+    # Sent with the reserved nonce, then the process died before recording the hash
+    db = session_factory()
+    entry = db.get(ChainOutbox, outbox_id)
+    entry.nonce, entry.nonce_block = 0, 0
+    db.commit()
+    db.close()
+    tx_hash = chain.apply({'from': SENDER, 'to': RECIPIENT, 'value': chain.to_wei(5, 'ether'), 'gas': 21000,
+                           'gasPrice': chain.to_wei(1, 'gwei'), 'nonce': 0})
+
+    asyncio.run(outbox.process_entry(outbox_id, session_factory))
+
+    entry = load(session_factory, outbox_id)
+    assert entry.status == OutboxStatus.CONFIRMED
+    assert entry.tx_hash == tx_hash.hex()
+    assert chain.balances[RECIPIENT] == chain.to_wei(5, 'ether')
+    assert chain.nonces[SENDER] == 1
+
+def test_unreachable_node_does_not_use_up_attempts(chain, session_factory):
+    outbox_id = queue_transfer(session_factory)
+    node = InMemoryNode(chain, "only", down=True)
+    blockchain.set_web3(node)
+
+    for _ in range(outbox.MAX_ATTEMPTS + 2):
+        retry_now(session_factory, outbox_id)
+        asyncio.run(outbox.process_entry(outbox_id, session_factory))
+
+    entry = load(session_factory, outbox_id)
+    assert entry.status == OutboxStatus.PENDING
+    assert entry.rejections == 0
+
+    node.down = False
+    retry_now(session_factory, outbox_id)
+    asyncio.run(outbox.process_entry(outbox_id, session_factory))
+    assert load(session_factory, outbox_id).status == OutboxStatus.CONFIRMED